@@ -0,0 +1,72 @@
+"""
+An asyncio API for building a Spectrum package from an uploaded PJNZ file,
+for use in web request handlers. The blocking work - parsing the DP sheet,
+reading EPP data in R and building each table - runs in executors, so the
+event loop stays responsive, and the tables are built concurrently.
+
+This module needs Python 3.6 or later.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+
+from adx_lib import instrumentation
+from adx_lib.pjnz_file import PJNZFile
+
+# A table built from an uploaded PJNZ file, or the error building it
+BuiltTable = namedtuple('BuiltTable', ['resource', 'table', 'error'])
+
+# R isn't thread safe, so every EPP read in this process runs on one thread
+_r_executor = ThreadPoolExecutor(max_workers=1)
+
+
+async def build_package(pjnz_bytes, registry, executor=None, **pjnz_kwargs):
+    """
+    Builds every table in a SchemaRegistry from the bytes, bytearray or
+    memoryview of a PJNZ file, without writing it to disk unless SpecIO needs a path.
+    The inputs planned by the registry are extracted up front: DP blocks
+    on the executor (by default the loop's) and EPP data on the R thread.
+    The tables are then built concurrently on the executor. Any EPP data
+    they read that wasn't read up front, e.g. for tables that couldn't be
+    planned or after a failed read, is still read on the R thread.
+    Work on the executors is recorded by the Recorder active in the caller.
+
+    This is an async generator - a BuiltTable is yielded as each table
+    finishes, e.g.
+
+        async for built in build_package(upload, get_registry(...)):
+            ...
+    """
+    loop = asyncio.get_event_loop()
+
+    # The file is opened lazily, and every EPP read is sent to the R thread.
+    bind = instrumentation.bind
+    pjnz_kwargs = dict(pjnz_kwargs, lazy=True, epp_executor=_r_executor)
+    pjnz = await loop.run_in_executor(
+        executor, bind(lambda: PJNZFile(pjnz_bytes, **pjnz_kwargs))
+    )
+    try:
+        plan = registry.plan()
+        await asyncio.gather(
+            loop.run_in_executor(executor, bind(plan.extract_dp), pjnz),
+            # Sends its reads to the R thread, so mustn't run there itself
+            loop.run_in_executor(executor, bind(plan.read_epp), pjnz)
+        )
+
+        def build_table(name, schemed_table):
+            try:
+                return BuiltTable(name, schemed_table.create_table(pjnz), None)
+            except Exception as e:
+                logging.exception("Failed to build " + name)
+                return BuiltTable(name, None, str(e))
+
+        builds = [
+            loop.run_in_executor(executor, bind(build_table), name, schemed_table)
+            for name, schemed_table in registry
+        ]
+        for build in asyncio.as_completed(builds):
+            yield await build
+    finally:
+        # Removes the copy on disk SpecIO reads, if one was made
+        await loop.run_in_executor(executor, bind(pjnz.close))
@@ -0,0 +1,216 @@
+"""
+Works out which inputs of a Spectrum File - DP blocks, EPP tables and the
+epidemic type - each table is built from, without building it. Inputs are
+keyed as in PJNZFile.input_hash, e.g. "dp:HAARTBySex MV" or "epp:anc.prev".
+
+Inputs are read from the table class's dp_tables, epp_tables and
+uses_epidemic_type attributes, the schema's declarative
+spectrum_file_mappings and, statically, from the dp() and epp() calls and
+epp_data lookups in its spectrum_file_key snippets. The types and columns
+each DP block is read as are worked out from the same places by
+dp_requests.
+"""
+import ast
+
+from adx_lib.pjnz_file import PJNZFile
+
+# The EPP tables read from PJNZ files, as opposed to those derived by tables
+EPP_TABLES = set(
+    table for tables in PJNZFile.epp_functions.values() for table in tables
+)
+
+# The names snippets refer to the spectrum file by, in build_spectrum_table
+SPECTRUM_FILE_NAMES = ('sf', 'spectrum_file')
+
+# Attributes of the spectrum file snippets may read that don't depend on
+# any input, or only on the epidemic type
+CONSTANT_ATTRIBUTES = ('year_range', 'default_columns')
+
+# The types snippets may read DP tables as, by name
+DP_TYPES = {'float': float, 'int': int, 'str': str}
+
+# Builtins that could reach the spectrum file without naming it
+UNSAFE_NAMES = ('locals', 'globals', 'vars', 'eval', 'exec', 'getattr')
+
+
+def table_inputs(schemed_table):
+    """
+    Returns the set of input keys a SchemedTable is built from, or None if
+    they can't all be worked out, e.g. a snippet calls dp() with a variable.
+    """
+    inputs = set('dp:' + tag for tag in schemed_table.dp_tables)
+    inputs.update('epp:' + table for table in schemed_table.epp_tables)
+    if schemed_table.uses_epidemic_type:
+        inputs.add('epidemic_type')
+
+    for field in schemed_table.schema.get('fields', []):
+        mapping = field.get('spectrum_file_mapping')
+        if mapping:
+            if 'dp' in mapping:
+                inputs.add('dp:' + mapping['dp'])
+            elif mapping['epp'] in EPP_TABLES:
+                inputs.add('epp:' + mapping['epp'])
+        if field.get('spectrum_file_key'):
+            snippet = snippet_inputs(field['spectrum_file_key'])
+            if snippet is None:
+                return None
+            inputs.update(snippet)
+
+    return inputs
+
+
+def dp_requests(schemed_table):
+    """
+    Returns a dict of the DP tags a SchemedTable reads, each to the set of
+    (type, columns) it is read as, or None if they can't all be worked out.
+    Tags read without a type or columns are read as configured in the
+    table's dp_tables.
+    """
+    calls = [(tag, None, None) for tag in schemed_table.dp_tables]
+    for field in schemed_table.schema.get('fields', []):
+        mapping = field.get('spectrum_file_mapping')
+        if mapping and 'dp' in mapping:
+            calls.append((mapping['dp'], None, None))
+        if field.get('spectrum_file_key'):
+            if snippet_inputs(field['spectrum_file_key'], calls) is None:
+                return None
+
+    requests = {}
+    for tag, type, columns in calls:
+        config = schemed_table.dp_tables.get(tag, {})
+        requests.setdefault(tag, set()).add((
+            type or config.get('type', float),
+            tuple(columns or config.get('columns', PJNZFile.default_columns))
+        ))
+    return requests
+
+
+def snippet_inputs(source, dp_calls=None):
+    """
+    Returns the set of input keys a spectrum_file_key snippet reads, or None
+    if they can't all be worked out statically. If a dp_calls list is given,
+    the (tag, type, columns) of each dp() call is appended to it, with None
+    for a type or columns not given.
+
+    Only these uses of the spectrum file are understood: dp() and epp()
+    calls and epp_data lookups with a literal name, and reads of the
+    epidemic_type and the constant year_range and default_columns. dp()
+    may also be given a literal type, e.g. int, and literal columns or
+    the constant year_range. Any other use, e.g. sf.extract_dp_table('X'),
+    sf.epp_data.get('subpops'), sf.dp('X', columns=years), sf.dp_tables[...]
+    or passing sf to a function, gives None.
+    """
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError:
+        return None
+
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+
+    inputs = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Name):
+            continue
+        if node.id in UNSAFE_NAMES:
+            return None
+        if node.id not in SPECTRUM_FILE_NAMES:
+            continue
+
+        attribute = parents.get(node)
+        if not isinstance(attribute, ast.Attribute):
+            return None
+        use = parents.get(attribute)
+
+        if attribute.attr in ('dp', 'epp'):
+            if not (isinstance(use, ast.Call) and use.func is attribute):
+                return None
+            name = _literal(use.args[0]) if use.args else None
+            if name is None:
+                return None
+            if attribute.attr == 'dp':
+                arguments = _dp_arguments(use)
+                if arguments is None:
+                    return None
+                inputs.add('dp:' + name)
+                if dp_calls is not None:
+                    dp_calls.append((name,) + arguments)
+            elif name in EPP_TABLES:
+                inputs.add('epp:' + name)
+
+        elif attribute.attr == 'epp_data':
+            if not (isinstance(use, ast.Subscript) and use.value is attribute):
+                return None
+            name = _literal(use.slice)
+            if name is None:
+                return None
+            if name in EPP_TABLES:
+                inputs.add('epp:' + name)
+
+        elif attribute.attr == 'epidemic_type':
+            inputs.add('epidemic_type')
+
+        elif attribute.attr not in CONSTANT_ATTRIBUTES:
+            return None
+
+    return inputs
+
+
+def _dp_arguments(call):
+    """
+    Returns the (type, columns) a dp() call reads its table as, each None if
+    not given, or None if either isn't a literal.
+    """
+    arguments = dict(zip(('type', 'columns'), call.args[1:]))
+    for keyword in call.keywords:
+        arguments[keyword.arg] = keyword.value
+    if (len(call.args) > 3 or set(arguments) - set(['type', 'columns']) or
+            getattr(call, 'starargs', None) or getattr(call, 'kwargs', None)):
+        return None  # Python 2 keeps *args and **kwargs apart
+
+    type = arguments.get('type')
+    if _is_none(type):
+        type = None
+    elif isinstance(type, ast.Name) and type.id in DP_TYPES:
+        type = DP_TYPES[type.id]
+    else:
+        return None
+
+    columns = arguments.get('columns')
+    if _is_none(columns):
+        columns = None
+    elif isinstance(columns, (ast.List, ast.Tuple)):
+        columns = [_literal(element) for element in columns.elts]
+        if None in columns:
+            return None
+    elif (isinstance(columns, ast.Attribute) and columns.attr in CONSTANT_ATTRIBUTES and
+            getattr(columns.value, 'id', None) in SPECTRUM_FILE_NAMES):
+        columns = getattr(PJNZFile, columns.attr)
+    else:
+        return None
+
+    return type, columns
+
+
+def _is_none(node):
+    # Whether an argument wasn't given, or is the literal None
+    if node is None:
+        return True
+    if isinstance(node, ast.Name):  # Python 2
+        return node.id == 'None'
+    return isinstance(node, getattr(ast, 'Constant', ())) and node.value is None
+
+
+def _literal(node):
+    # Returns the string a node holds, or None if it isn't a string literal
+    if isinstance(node, getattr(ast, 'Index', ())):  # Python < 3.9 wraps subscripts
+        node = node.value
+    if isinstance(node, getattr(ast, 'Constant', ())):
+        value = node.value
+    else:
+        value = getattr(node, 's', None)  # Python 2 strings
+    if isinstance(value, str) or type(value).__name__ == 'unicode':
+        return value
+    return None
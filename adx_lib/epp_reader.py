@@ -0,0 +1,300 @@
+"""
+A native Python reader for the EPP data stored in the .xml member of a PJNZ
+file. It mirrors the read_epp_data and read_epp_subpops functions of
+Imperial's SpecIO R package (which come from the eppasm package), and
+produces tables in the same shape that PJNZFile.epp builds from SpecIO's
+output - without starting R. test_epp_reader checks it against expected
+tables for the fixture in test/fixtures, which were derived by hand rather
+than saved from SpecIO. epp_parity compares it with SpecIO on real files.
+
+EPP serialises its projects with Java's XMLEncoder, so the xml is first
+decoded into plain Python values: objects become dicts of their properties,
+collections built with add() become lists and arrays become lists. XMLEncoder
+omits elements holding Java's default value - these are False or 0 in
+boolean and integer arrays, and None (missing) in any others.
+"""
+import xml.etree.ElementTree as ElementTree
+import numpy
+import pandas
+
+# ANC surveillance matrices start in 1985, one column per year
+ANC_START_YEAR = 1985
+
+# EPP property names for the site level ANC data, by read_epp_data table
+# prefix. Each maps to the (prevalence property, sample size property) the
+# .prev and .n tables are built from.
+ANC_TABLES = {
+    'anc': ('survData', 'survSampleSizes'),
+    'ancrtsite': ('siteANCRTPrevalence', 'siteANCRTSampleSizes')
+}
+
+# Java's default values of the primitive array types, which XMLEncoder omits.
+# Omitted doubles are left missing, as SpecIO reads them.
+ARRAY_DEFAULTS = {
+    'boolean': False,
+    'int': 0,
+    'long': 0,
+    'short': 0,
+    'byte': 0
+}
+
+# EPP property names for each column of the household survey table, and the
+# scale of each. Percentages are converted to proportions.
+SURVEY_COLUMNS = [
+    ('year', 'surveyYears', 1),
+    ('prev', 'surveyHIV', 0.01),
+    ('se', 'surveyStandardError', 0.01),
+    ('n', 'surveySampleSize', 1),
+    ('used', 'surveyIsUsed', 1)
+]
+
+# EPP property names for each column of a sub-population table
+SUBPOP_COLUMNS = [
+    ('pop15to49', 'pop15to49'),
+    ('pop15', 'pop15'),
+    ('pop50', 'pop50'),
+    ('netmigr', 'netMigration')
+]
+
+
+def read_epp_data(pjnz_file):
+    """
+    Reads the ANC and household survey tables from a zipfile.ZipFile of a
+    PJNZ. Returns a dict mapping each table name to a dataframe combining
+    the data for every group (region or sub-population), or None.
+    """
+    project = _read_project(pjnz_file)
+    tables = {}
+
+    for prefix, (prev_property, n_property) in ANC_TABLES.items():
+        prev_data = []
+        n_data = []
+        for group, epp_set in _epp_sets(project):
+            data_frames = _site_matrices(epp_set, prev_property, n_property)
+            if data_frames is not None:
+                for complete_data, data_frame in zip((prev_data, n_data), data_frames):
+                    data_frame['Group'] = group
+                    complete_data.append(data_frame)
+        tables[prefix + '.prev'] = pandas.concat(prev_data) if prev_data else None
+        tables[prefix + '.n'] = pandas.concat(n_data) if n_data else None
+
+    complete_data = []
+    for group, epp_set in _epp_sets(project):
+        data_frame = _household_surveys(epp_set)
+        if data_frame is not None:
+            data_frame['Group'] = group
+            complete_data.append(data_frame)
+    tables['hhs'] = pandas.concat(complete_data) if complete_data else None
+
+    return tables
+
+
+def read_epp_subpops(pjnz_file):
+    """
+    Reads the sub-population sizes and turnover durations from a
+    zipfile.ZipFile of a PJNZ. Returns a dict holding the 'subpops' and
+    'turnover' tables, and the epidemic type.
+    """
+    project = _read_project(pjnz_file)
+    years = range(
+        project.get('worksetStartYear', 1970),
+        project.get('worksetEndYear', 2021) + 1
+    )
+    pops_data = []
+    turnover_data = []
+
+    for group, epp_set in _epp_sets(project):
+        # Get the population data
+        columns = [(name, _as_list(epp_set.get(prop))) for name, prop in SUBPOP_COLUMNS]
+        if all(values for name, values in columns):
+            data_frame = pandas.DataFrame(
+                dict([('year', list(years))] + [
+                    (name, _as_floats(values, len(years)))
+                    for name, values in columns
+                ]),
+                columns=['year'] + [name for name, prop in SUBPOP_COLUMNS],
+                index=[str(n + 1) for n in range(len(years))]
+            )
+            data_frame['Group'] = group
+            pops_data.append(data_frame)
+
+        # Get the turnover data
+        duration = epp_set.get('duration')
+        if duration is None:
+            duration = numpy.nan
+        turnover_data.append(pandas.DataFrame({group: duration}, index=['Duration']))
+
+    tables = {
+        'subpops': pandas.concat(pops_data) if pops_data else None,
+        'turnover': pandas.concat(turnover_data, axis='columns') if turnover_data else None
+    }
+    epidemic_type = project.get('epidemicType')
+    if epidemic_type is not None:
+        epidemic_type = str(epidemic_type).lower()
+
+    return tables, epidemic_type
+
+
+def _read_project(pjnz_file):
+    """
+    Decodes the EPP project object from the .xml member of the PJNZ, or
+    from an already opened binary xml file.
+    """
+    if hasattr(pjnz_file, 'namelist'):
+        xml_files = [n for n in pjnz_file.namelist() if n.lower().endswith('.xml')]
+        if not xml_files:
+            raise ValueError("EPP .xml file not found in PJNZ")
+        xml_file = pjnz_file.open(xml_files[0])
+    else:
+        xml_file = pjnz_file
+    with xml_file as f:
+        root = ElementTree.parse(f).getroot()
+    project = root.find('object')
+    return _decode(project) if project is not None else {}
+
+
+def _epp_sets(project):
+    """
+    Yields the name and properties of each EPP set (region or sub-population).
+    """
+    for epp_set in _as_list(project.get('eppSetChildren')):
+        if isinstance(epp_set, dict):
+            yield epp_set.get('name'), epp_set
+
+
+def _site_matrices(epp_set, prev_property, n_property):
+    """
+    Builds the site by year prevalence and sample size matrices, as SpecIO
+    does. There is a column for each year of prevalence data. Values
+    omitted by the encoder, or of -1, are missing, and so is the prevalence
+    wherever the sample size is.
+    """
+    site_names = _as_list(epp_set.get('siteNames'))
+    prev_rows = _as_list(epp_set.get(prev_property))
+    if not site_names or not prev_rows:
+        return None
+
+    num_years = max(len(_as_list(row)) for row in prev_rows)
+    prev = _site_matrix(prev_rows, len(site_names), num_years)
+    n = _site_matrix(_as_list(epp_set.get(n_property)), len(site_names), num_years)
+    prev[numpy.isnan(n)] = numpy.nan
+
+    columns = [str(ANC_START_YEAR + year) for year in range(num_years)]
+    return (
+        pandas.DataFrame(prev * 0.01, index=site_names, columns=columns),
+        pandas.DataFrame(n, index=site_names, columns=columns)
+    )
+
+
+def _site_matrix(rows, num_sites, num_years):
+    matrix = numpy.full((num_sites, num_years), numpy.nan)
+    for n, row in enumerate(rows[:num_sites]):
+        row = [numpy.nan if v is None else v for v in _as_list(row)[:num_years]]
+        matrix[n, :len(row)] = row
+    matrix[matrix == -1] = numpy.nan
+    return matrix
+
+
+def _household_surveys(epp_set):
+    """
+    Builds the household survey table from the parallel survey arrays,
+    dropping surveys without prevalence. Omitted years, sample sizes and
+    used flags are 0, and omitted prevalences and standard errors missing.
+    """
+    columns = [
+        (name, _as_list(epp_set.get(prop)), scale)
+        for name, prop, scale in SURVEY_COLUMNS
+    ]
+    num_surveys = max(len(values) for name, values, scale in columns)
+    if not num_surveys:
+        return None
+
+    data_frame = pandas.DataFrame(
+        dict(
+            (name, [
+                numpy.nan if v is None else float(v) * scale for v in values
+            ] + [numpy.nan] * (num_surveys - len(values)))
+            for name, values, scale in columns
+        ),
+        columns=[name for name, values, scale in columns],
+        index=[str(n + 1) for n in range(num_surveys)]
+    )
+    return data_frame[data_frame['prev'].notnull()]
+
+
+def _as_list(value):
+    """
+    Normalises a decoded collection into a list. Collections modified in
+    place by the encoder are decoded as dicts of index to value.
+    """
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        if not value:
+            return []
+        values = [None] * (max(value.keys()) + 1)
+        for n, v in value.items():
+            values[n] = v
+        return values
+    return list(value)
+
+
+def _as_floats(values, length):
+    # The encoder omits zeros, so only values past the end of the array are missing
+    values = [0.0 if v is None else float(v) for v in values[:length]]
+    return values + [numpy.nan] * (length - len(values))
+
+
+def _decode(element):
+    """
+    Decodes an XMLEncoder element into a plain Python value.
+    """
+    tag = element.tag
+    if tag == 'string':
+        return element.text or u''
+    if tag in ('double', 'float'):
+        return float(element.text)
+    if tag in ('int', 'long', 'short', 'byte'):
+        return int(element.text)
+    if tag == 'boolean':
+        return element.text == 'true'
+    if tag == 'null':
+        return None
+    if tag == 'array':
+        values = [ARRAY_DEFAULTS.get(element.get('class'))] * int(element.get('length', 0))
+        for child in element:
+            if child.tag == 'void' and child.get('index') is not None:
+                values[int(child.get('index'))] = _decode_void(child)
+        return values
+    if tag == 'object':
+        # Enum constants are encoded as a static field or a valueOf() call
+        if element.get('field') is not None:
+            return element.get('field')
+        if element.get('method') == 'valueOf':
+            return _decode(element.findall('string')[-1])
+        return _decode_void(element)
+    return element.text
+
+
+def _decode_void(element):
+    """
+    Decodes the children of an object or void element. A single value child
+    is the value itself, otherwise nested voids set properties, indices or
+    add() items on the value.
+    """
+    values = [c for c in element if c.tag not in ('void', 'class')]
+    if values and element.tag == 'void':
+        return _decode(values[0])
+
+    properties = {}
+    items = []
+    for child in element:
+        if child.tag != 'void':
+            continue
+        if child.get('property') is not None:
+            properties[child.get('property')] = _decode_void(child)
+        elif child.get('index') is not None:
+            properties[int(child.get('index'))] = _decode_void(child)
+        elif child.get('method') == 'add':
+            items.append(_decode_void(child))
+    return items if items and not properties else properties
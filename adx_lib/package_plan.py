@@ -0,0 +1,110 @@
+"""
+Plans the extraction of every input a package's tables need from a PJNZ
+file, so that it can all be extracted up front in one batch - each DP block
+once, and each SpecIO function called at most once - before any table is
+assembled.
+"""
+from adx_lib.dependencies import dp_requests
+from adx_lib.pjnz_file import PJNZFile
+import logging
+
+
+class PackagePlan(object):
+    """
+    The DP tags (with the types and columns they are read as) and EPP tables
+    that the tables in a SchemaRegistry read, worked out from the inputs
+    the registry found for each table. Tables whose inputs couldn't be
+    worked out are listed as unplanned - they extract what they need as
+    they are built.
+    """
+
+    def __init__(self, registry):
+        self.dp_requests = {}   # Tag -> set of (type, columns) to read it as
+        self.epp_tables = set()
+        self.unplanned = []
+
+        for name, schemed_table in registry:
+            inputs = registry.inputs[name]
+            requests = dp_requests(schemed_table) if inputs is not None else None
+            if requests is None:
+                self.unplanned.append(name)
+                continue
+            for tag, configs in requests.items():
+                self.dp_requests.setdefault(tag, set()).update(configs)
+            for key in inputs:
+                kind, _, input_name = key.partition(':')
+                if kind == 'epp':
+                    self.epp_tables.add(input_name)
+                elif kind == 'epidemic_type':
+                    self.epp_tables.add('subpops')
+
+    @property
+    def epp_functions(self):
+        """
+        The SpecIO functions to call, each with the tables read from it.
+        """
+        return dict(
+            (function, sorted(self.epp_tables.intersection(tables)))
+            for function, tables in PJNZFile.epp_functions.items()
+            if self.epp_tables.intersection(tables)
+        )
+
+    def execute(self, pjnz):
+        """
+        Extracts every planned DP table and EPP table from a PJNZFile.
+        """
+        self.extract_dp(pjnz)
+        self.read_epp(pjnz)
+
+    def extract_dp(self, pjnz):
+        """
+        Extracts every planned DP table, after a single pass over the DP
+        sheet. Tables that can't be extracted are left for the tables needing
+        them to report.
+        """
+        for tag, configs in sorted(self.dp_requests.items()):
+            for type, columns in configs:
+                try:
+                    pjnz.dp(tag, type, list(columns))
+                except Exception as e:
+                    logging.debug("Can't prefetch " + tag + ": " + str(e))
+
+    def read_epp(self, pjnz):
+        """
+        Reads every planned EPP table, calling each SpecIO function once.
+        """
+        for function, tables in self.epp_functions.items():
+            try:
+                pjnz.epp(tables[0])
+            except Exception as e:
+                logging.debug("Can't prefetch " + function + ": " + str(e))
+
+    def describe(self):
+        """
+        Describes the plan in a human readable form, for debugging.
+        """
+        lines = ["DP tables:"]
+        for tag, configs in sorted(self.dp_requests.items()):
+            for type, columns in sorted(configs, key=str):
+                lines.append("  {} as {} ({} columns{})".format(
+                    tag,
+                    getattr(type, '__name__', type),
+                    len(columns),
+                    ", dropping " + str(columns.count("Drop")) if "Drop" in columns else ""
+                ))
+        lines.append("EPP tables:")
+        for function, tables in sorted(self.epp_functions.items()):
+            lines.append("  {}: {}".format(function, ", ".join(tables)))
+        if self.unplanned:
+            lines.append("Unplanned tables: " + ", ".join(self.unplanned))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.describe()
+
+
+if __name__ == '__main__':
+    # Prints the plan for a package schema and schema directory
+    import sys
+    from adx_lib.schema_registry import get_registry
+    print(get_registry(sys.argv[1], sys.argv[2]).plan())
@@ -0,0 +1,279 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy
+import pandas
+
+
+class PJNZCache(object):
+    """
+    A size bounded, on-disk cache of tables extracted from PJNZ files. Tables
+    are filed under a hash of the PJNZ file contents, and stored column by
+    column in numpy .npz archives so they load without any parsing. When the
+    cache grows beyond max_bytes the least recently used tables are evicted.
+
+    The size of the cache is counted once, when it is first written to, and
+    kept up to date as tables are stored. Tables stored by other processes
+    sharing the directory are only counted once the cache next evicts.
+    """
+
+    suffix = '.npz'
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, stale_seconds=60 * 60):
+        """
+        Temporary files left for longer than stale_seconds by writers that
+        died are deleted whenever the cache is counted.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        self._total_bytes = None
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def file_hash(fpath, chunk_size=1024 * 1024):
+        """
+        Returns a hash of the contents of the file at fpath.
+        """
+        digest = hashlib.sha1()
+        with open(fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def buffer_hash(buffer):
+        """
+        Returns a hash of the contents of a file held in memory, matching
+        file_hash of the same file on disk.
+        """
+        return hashlib.sha1(buffer).hexdigest()
+
+    @staticmethod
+    def replace_file(temp_path, path):
+        """
+        Moves a fully written temporary file to path, replacing any file
+        there. Files are only written under a name derived from their
+        contents, so if another process's copy can't be replaced - e.g. it
+        is open on Windows, or Python 2 can't rename over it - that copy is
+        kept and the temporary file deleted.
+        """
+        try:
+            getattr(os, 'replace', os.rename)(temp_path, path)
+        except OSError:
+            if not os.path.exists(path):
+                raise
+            os.remove(temp_path)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Builds a table key from its describing parts, e.g. the DP tag and the
+        type and columns it is extracted with.
+        """
+        description = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def get(self, file_hash, key):
+        """
+        Looks up a table. Returns a (found, table, meta) tuple, where meta is
+        the dict of extra values stored alongside the table. A cached table
+        of None counts as found, while a table that can't be decoded is
+        deleted and counts as a miss.
+        """
+        path = self._path(file_hash, key)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            return False, None, {}
+        try:
+            with f:
+                archive = numpy.load(f, allow_pickle=False)
+                meta = json.loads(str(archive['meta']))
+                table = PJNZCache._decode_table(archive, meta)
+        except Exception:
+            # e.g. a truncated archive, or one written by an older version
+            self._remove(path)
+            return False, None, {}
+
+        os.utime(path, None)  # Mark as recently used
+        return True, table, meta.get('extra', {})
+
+    def put(self, file_hash, key, table, **extra):
+        """
+        Stores a table (or None) along with any extra json-able values, then
+        evicts old tables if the cache has grown too large.
+        """
+        path = self._path(file_hash, key)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if self._total_bytes is None:
+            self.evict()
+
+        arrays, meta = PJNZCache._encode_table(table)
+        meta['extra'] = extra
+
+        # Write to a temporary file first so readers never see partial tables
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                numpy.savez(f, meta=numpy.array(json.dumps(meta)), **arrays)
+            size = os.path.getsize(temp_path)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            PJNZCache.replace_file(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._total_bytes += size - replaced
+            full = self._total_bytes > self.max_bytes
+        if full:
+            self.evict()
+
+    def evict(self):
+        """
+        Counts the cache, deleting stale temporary files, then deletes the
+        least recently used tables until it fits within max_bytes.
+        """
+        entries = []
+        total = 0
+        stale = time.time() - self.stale_seconds
+        for root, dirs, files in os.walk(self.directory):
+            for fname in files:
+                path = os.path.join(root, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # Removed by another process
+                if fname.endswith(PJNZCache.suffix):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+                elif fname.endswith('.tmp') and stat.st_mtime < stale:
+                    PJNZCache._remove_file(path)
+
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            PJNZCache._remove_file(path)
+            total -= size
+
+        with self._lock:
+            self._total_bytes = total
+
+    def _remove(self, path):
+        # Deletes a table, keeping count of the size of the cache
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if PJNZCache._remove_file(path):
+            with self._lock:
+                if self._total_bytes is not None:
+                    self._total_bytes -= size
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False  # Another process got there first
+
+    def _path(self, file_hash, key):
+        return os.path.join(self.directory, file_hash, key + PJNZCache.suffix)
+
+    @staticmethod
+    def _encode_table(table):
+        """
+        Splits a dataframe into one numpy array per column (plus its index).
+        Object columns are stored as unicode with a separate mask of nulls,
+        nullable integer columns as integers with a mask. The name and tag
+        set on DP tables are kept in the meta.
+        """
+        if table is None:
+            return {}, {'none': True}
+
+        arrays = {}
+        meta = {
+            'none': False,
+            'columns': [PJNZCache._jsonable(c) for c in table.columns],
+            'index_name': PJNZCache._jsonable(table.index.name),
+            'masked': [],
+            'nullable': [],
+            # Set as plain attributes, so not looked up as columns
+            'attributes': dict(
+                (a, vars(table)[a]) for a in ('name', 'tag') if a in vars(table)
+            )
+        }
+        series = [('index', numpy.asarray(table.index))]
+        series += [
+            ('column_' + str(n), numpy.asarray(table.iloc[:, n]))
+            for n in range(len(table.columns))
+        ]
+        for n in range(len(table.columns)):
+            column = table.iloc[:, n]
+            if str(column.dtype) == 'Int64':
+                name = 'column_' + str(n)
+                series[n + 1] = (name, column.fillna(0).astype('int64').values)
+                arrays[name + '_mask'] = column.isnull().values
+                meta['nullable'].append(name)
+
+        for name, values in series:
+            if values.dtype == object:
+                mask = pandas.isnull(values)
+                arrays[name + '_mask'] = mask
+                values = numpy.array(
+                    [u'' if m else PJNZCache._text(v) for v, m in zip(values, mask)],
+                    dtype='U'
+                )
+                meta['masked'].append(name)
+            arrays[name] = values
+
+        return arrays, meta
+
+    @staticmethod
+    def _decode_table(archive, meta):
+        if meta['none']:
+            return None
+
+        def column(name):
+            values = archive[name]
+            if name in meta.get('nullable', []):
+                return pandas.arrays.IntegerArray(values, archive[name + '_mask'])
+            if name in meta['masked']:
+                values = values.astype(object)
+                values[archive[name + '_mask']] = numpy.nan
+            return values
+
+        table = pandas.DataFrame(
+            dict(
+                (n, column('column_' + str(n)))
+                for n in range(len(meta['columns']))
+            ),
+            columns=range(len(meta['columns'])),
+            index=pandas.Index(column('index'), name=meta['index_name'])
+        )
+        table.columns = meta['columns']
+        for attribute, value in meta.get('attributes', {}).items():
+            setattr(table, attribute, value)
+        return table
+
+    @staticmethod
+    def _text(value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return u'{}'.format(value)
+
+    @staticmethod
+    def _jsonable(value):
+        # Numpy scalars can't be serialised to json directly
+        if hasattr(value, 'item'):
+            return value.item()
+        return value
@@ -1,96 +1,410 @@
-from rpy2.robjects import r, pandas2ri, packages
-from rpy2.rinterface import NALogicalType
+from adx_lib import epp_reader
+from adx_lib import instrumentation
+from adx_lib.pjnz_cache import PJNZCache
+from adx_lib.specio_engine import engine as specio
 import pandas
 import numpy
 import zipfile
+import codecs
+import csv
+import hashlib
 import io
+import json
+import os
+import shutil
+import sys
+import tempfile
 import logging
+import mmap
+import threading
+
+# Marks the threads running EPP reads for an epp_executor, so that EPP data
+# needed within a read is read there too, rather than queued behind it
+_epp_thread = threading.local()
+
+
+class DPBlock(object):
+    """
+    Describes a tagged block of the DP sheet: its table name, the rows it
+    spans in the sheet and the byte offsets of its data in the raw sheet.
+    Once decoded, its data cells (4th column onwards) are held compactly:
+    data holds the utf-8 text of every cell, row by row, and offsets the
+    position in that text where each cell starts, with the end of the text
+    last. shape is the number of rows, and the number of cells in the
+    widest row - shorter rows are padded with empty cells.
+    """
+    __slots__ = ('name', 'start_row', 'end_row', 'start', 'end', 'shape', 'data', 'offsets')
+
+    def __init__(self, start_row, start=None):
+        self.name = None
+        self.start_row = start_row
+        self.end_row = None
+        self.start = start
+        self.end = None
+        self.shape = None
+        self.data = None
+        self.offsets = None
+
+    def pack(self, rows):
+        """
+        Packs the data rows of the block, each a list of cells, into its
+        data and offsets.
+        """
+        width = max([len(row) for row in rows] + [0])
+        cells = [cell for row in rows for cell in row + [''] * (width - len(row))]
+        text = ''.join(cells)
+        offsets = numpy.zeros(len(cells) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(cell) for cell in cells], out=offsets[1:])
+
+        # Offsets are counted in the units the csv module reads - characters
+        # in Python 3 and bytes in Python 2 - in the smallest type that fits.
+        self.shape = (len(rows), width)
+        self.data = text if isinstance(text, bytes) else text.encode('utf-8')
+        self.offsets = offsets.astype(numpy.min_scalar_type(len(text)))
+
+    def cells(self, width=None):
+        """
+        Returns the cells of the block as a 2D array of strings, trimmed or
+        padded with empty cells to width columns. The array is only as wide
+        as its longest cell, so is best built only for the cells needed.
+        """
+        rows, columns = self.shape
+        width = columns if width is None else width
+        used = min(width, columns)
+        offsets = self.offsets.astype(numpy.int64)
+        starts = offsets[:-1].reshape(rows, columns)[:, :used]
+        lengths = offsets[1:].reshape(rows, columns)[:, :used] - starts
+        longest = int(lengths.max()) if lengths.size else 0
+
+        if longest == 0:
+            cells = numpy.zeros((rows, used), dtype=str)
+        elif offsets[-1] == len(self.data):
+            # Offsets count bytes when the text is ascii (or in Python 2), so
+            # the cells are copied straight from the data in one go, each
+            # byte to its place in a null padded array. Only the bytes of the
+            # cells used are indexed, however long the longest cell is.
+            data = numpy.frombuffer(self.data, dtype=numpy.uint8)
+            lengths = lengths.ravel()
+            within = numpy.arange(int(lengths.sum())) - numpy.repeat(
+                numpy.cumsum(lengths) - lengths, lengths
+            )
+            cell = numpy.repeat(numpy.arange(lengths.size), lengths)
+            gathered = numpy.zeros(lengths.size * longest, dtype=numpy.uint8)
+            gathered[cell * longest + within] = data[numpy.repeat(starts.ravel(), lengths) + within]
+            cells = gathered.view('S' + str(longest)).reshape(rows, used).astype(str)
+        else:
+            text = codecs.utf_8_decode(self.data)[0]
+            cells = numpy.array([
+                [text[s:s + n] for s, n in zip(row_starts, row_lengths)]
+                for row_starts, row_lengths in zip(starts.tolist(), lengths.tolist())
+            ], dtype=str).reshape(rows, used)
 
-# Setup R packages used by SpecIO to extract data.
-utils = packages.importr("utils")
-if not packages.isinstalled('devtools'):
-    utils.install_packages('devtools')
-    packages.importr("devtools")
-if not packages.isinstalled('specio'):
-    r['install_github']('mrc-ide/specio')
-packages.importr("specio")
-pandas2ri.activate()
+        if used < width:
+            padding = numpy.zeros((rows, width - used), dtype=cells.dtype)
+            cells = numpy.concatenate([cells, padding], axis=1)
+        return cells
 
 
-class PJNZFile():
+class PJNZFile(object):
 
     # Determines the files in the PJNZ that we want to import to Pandas
     # Key is the suffix, Value specifies kwargs sent to read_csv
+    # The .DP sheet is always streamed into tagged blocks instead.
     file_suffixes = {
         '.DP': {'dtype': str}
     }
-    year_range = map(lambda x: str(x), range(1970, 2026))
+    year_range = [str(x) for x in range(1970, 2026)]
     default_columns = year_range
 
-    def __init__(self, fpath, file_suffixes=file_suffixes, country=None):
+    # Details the R functions available and tables of data they export.
+    epp_functions = {
+        "read_epp_data": [
+            'anc.prev',
+            'anc.n',
+            'ancrtsite.prev',
+            'ancrtsite.n',
+            'hhs'
+        ],
+        "read_epp_subpops": [
+            'subpops',
+            'turnover'
+        ]
+    }
+
+    def __init__(self, fpath, file_suffixes=file_suffixes, country=None,
+                 lazy=False, cache=None, epp_backend='specio', prefetch_epp=False,
+                 spill_directory=None, epp_executor=None):
         """
-        Files are extracted upon object creation.
+        Files are extracted upon object creation. In lazy mode only the
+        byte offsets of each tagged DP block are recorded up front - blocks
+        are decoded the first time they are asked for, and the EPP data is
+        only read once the epidemic type is needed.
+
+        If a PJNZCache is given, extracted dp() and epp() tables are stored in
+        it, and files are only extracted once a table misses the cache.
+
+        EPP data is read through SpecIO in R by default. An epp_backend of
+        'native' reads it with the pure Python epp_reader module instead.
+        With prefetch_epp, every EPP table is read up front by epp_all().
+        If an epp_executor (a concurrent.futures executor) is given, every
+        EPP read is run on it and waited for, e.g. on the single thread
+        allowed to use R. epp() must then not be called from a task already
+        running on the executor, which would wait on itself.
+
+        Instead of a path, fpath may be the contents of a PJNZ file, as
+        bytes (under Python 3, as bytes are paths in Python 2), a bytearray
+        or memoryview, or a binary file object. Members are then
+        read straight from memory, the file name is taken from the DP sheet
+        within it, and the file is only written to disk if a path is needed,
+        i.e. by SpecIO - see local_path.
+
+        If a spill_directory is given, each member read is decompressed into
+        it once, under a name derived from the member's checksum, and then
+        memory mapped. Processes spilling the same PJNZ to the same directory
+        share the decompressed files, and their pages. SpecIO still reads the
+        PJNZ file itself.
+
+        A PJNZFile can be shared between threads - tables are only extracted
+        by one thread at a time, and each is extracted once. Per table
+        configurations and derived tables should be given to a view() of the
+        file rather than set on the shared file.
         """
-        self.fpath = fpath
-        self.fname = fpath.split('/')[-1][:-5]  # fName w/o path or extension
-        self.file_suffixes = file_suffixes
-        self.pjnz_file = zipfile.PyZipFile(fpath)
-        self.epp_data = {}
-        self.dp_tables = {}
-        self.epp('subpops')  # This calculates self.epidemic_type
+        self._init_attributes(
+            file_suffixes, lazy, cache, epp_backend, spill_directory, epp_executor
+        )
+        buffer = PJNZFile._in_memory_buffer(fpath)
+        if buffer is None:
+            self.fpath = fpath
+            self.fname = fpath.split('/')[-1][:-5]  # fName w/o path or extension
+            with instrumentation.span('zip open', fpath=fpath):
+                self.pjnz_file = zipfile.PyZipFile(fpath)
+        else:
+            with instrumentation.span('zip open', fpath=None):
+                self.pjnz_file = zipfile.PyZipFile(io.BytesIO(buffer))
+            self.fname = PJNZFile._member_fname(self.pjnz_file)
+        self._buffer = buffer
+        if cache and buffer is not None:
+            self.file_hash = cache.buffer_hash(buffer)
+        else:
+            self.file_hash = cache.file_hash(fpath) if cache else None
+        if prefetch_epp:
+            self.epp_all()
+        elif not lazy:
+            self.epp('subpops')  # This calculates self.epidemic_type
         if country:
             self.country = country
-        else:
+        elif self.fpath:
             self.country = fpath.split('/')[-1].split('_')[0]
+        else:
+            self.country = self.fname.split('_')[0]
 
-        self._extract_files()
+        if not cache:
+            self._extract_files()
+
+    @classmethod
+    def from_tables(cls, fname, dp_blocks, epp_data, epidemic_type=None,
+                    fpath=None, country=None):
+        """
+        Builds a PJNZFile from tables that have already been parsed, without
+        any PJNZ file to read: dp_blocks maps bracketed tags to decoded
+        DPBlocks, and epp_data maps EPP table names to tables (or None).
+        Only those blocks and tables can be read from it - dp() raises a
+        ValueError for any other tag, as epp() does for any other table.
+        """
+        pjnz = cls.__new__(cls)
+        pjnz._init_attributes()
+        pjnz.fpath = fpath
+        pjnz.fname = fname
+        pjnz.country = country or fname.split('_')[0]
+        pjnz.dataframes = {}
+        pjnz.dp_index = dict(dp_blocks)
+        pjnz.epp_data = dict(epp_data)
+        pjnz._epidemic_type = epidemic_type
+        return pjnz
+
+    def _init_attributes(self, file_suffixes=file_suffixes, lazy=False, cache=None,
+                         epp_backend='specio', spill_directory=None, epp_executor=None):
+        # Sets up the state of a file before anything has been read from it
+        self._lock = threading.RLock()
+        self._epp_lock = threading.RLock()  # EPP data is read independently
+        self._local_copy_directory = None
+        self._mmaps = []
+        self._buffer = None
+        self.file_suffixes = file_suffixes
+        self.lazy = lazy
+        self.cache = cache
+        self.epp_backend = epp_backend
+        self.spill_directory = spill_directory
+        self.epp_executor = epp_executor
+        self.fpath = None
+        self.fname = None
+        self.country = None
+        self.pjnz_file = None
+        self.file_hash = None
+        self.epp_data = {}
+        self.dp_tables = {}
+        self.dp_data = {}
+        self.input_hashes = {}
+        self.dataframes = None
+        self.dp_buffer = None
+        self.dp_index = None
+        self._epidemic_type = None
+
+    @property
+    def local_path(self):
+        """
+        A path to the PJNZ file on disk. PJNZ files opened from memory are
+        written to a temporary file the first time a path is needed, which
+        is removed by close().
+        """
+        if self.fpath:
+            return self.fpath
+        with self._lock:
+            if self._local_copy_directory is None:
+                directory = tempfile.mkdtemp(prefix='pjnz')
+                with open(os.path.join(directory, self.fname + '.PJNZ'), 'wb') as f:
+                    f.write(self._buffer)
+                self._local_copy_directory = directory
+        return os.path.join(self._local_copy_directory, self.fname + '.PJNZ')
+
+    def close(self):
+        """
+        Closes the PJNZ file and its memory mapped members, and removes any
+        temporary copy of it on disk.
+        """
+        if self.pjnz_file is not None:
+            self.pjnz_file.close()
+        self.dp_buffer = None
+        for member_map in self._mmaps:
+            member_map.close()
+        self._mmaps = []
+        if self._local_copy_directory is not None:
+            shutil.rmtree(self._local_copy_directory, True)
+            self._local_copy_directory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _extract_files(self):
         """
         This funtion takes each of the specified file_suffixes and try's to
-        import it as a Pandas dataframe, using the specified kwargs.
+        import it as a Pandas dataframe, using the specified kwargs. The DP
+        sheet is the exception - it is streamed into tagged blocks instead.
         """
         self.dataframes = {}
+        self.dp_buffer = None
+        self.dp_index = None
         for file_suffix, kwargs in self.file_suffixes.items():
             filename = self.fname + file_suffix
-            self.dataframes[filename] = pandas.read_csv(
-                PJNZFile._add_delimiters(
-                    self.pjnz_file.open(filename, 'r')
-                ),
-                **kwargs
-            )
+            with instrumentation.span('extract', file=filename, lazy=self.lazy) as span:
+                span.set(bytes=self.pjnz_file.getinfo(filename).file_size)
+                if file_suffix == '.DP' and self.lazy:
+                    self.dp_buffer = self._read_member(filename)
+                    self.dp_index = PJNZFile._index_dp_buffer(self.dp_buffer)
+                    span.set(tags=len(self.dp_index))
+                elif file_suffix == '.DP':
+                    self.dp_index = PJNZFile._read_dp_sheet(
+                        self._open_member(filename)
+                    )
+                    span.set(tags=len(self.dp_index))
+                else:
+                    self.dataframes[filename] = pandas.read_csv(
+                        PJNZFile._add_delimiters(
+                            self._open_member(filename)
+                        ),
+                        **kwargs
+                    )
+                    span.set(rows=len(self.dataframes[filename]))
+
+    def _open_member(self, name):
+        """
+        Opens a member of the PJNZ as a binary file, from the spill
+        directory if there is one.
+        """
+        if self.spill_directory:
+            return io.open(self._spill_member(name), 'rb')
+        return self.pjnz_file.open(name, 'r')
+
+    def _read_member(self, name):
+        """
+        Returns the bytes of a member of the PJNZ. With a spill directory
+        these are a read only memory map of the decompressed member.
+        """
+        if not self.spill_directory:
+            return self.pjnz_file.read(name)
+
+        with io.open(self._spill_member(name), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''  # Empty files can't be mapped
+            member_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps.append(member_map)
+        return member_map
+
+    def _spill_member(self, name):
+        """
+        Decompresses a member of the PJNZ into the spill directory, unless it
+        is already there, and returns its path. Members are written to a
+        temporary file first, so other processes never see partial files.
+        """
+        info = self.pjnz_file.getinfo(name)
+        directory = os.path.join(
+            self.spill_directory,
+            '{}-{:08x}-{}'.format(self.fname, info.CRC, info.file_size)
+        )
+        path = os.path.join(directory, os.path.basename(name))
+        if os.path.exists(path):
+            return path
+
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                with self.pjnz_file.open(name, 'r') as member:
+                    shutil.copyfileobj(member, f)
+            PJNZCache.replace_file(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return path
+
+    def _epp_source(self):
+        # The native EPP reader reads the spilled xml member, if spilling
+        if not self.spill_directory:
+            return self.pjnz_file
+        xml_files = [n for n in self.pjnz_file.namelist() if n.lower().endswith('.xml')]
+        if not xml_files:
+            return self.pjnz_file  # Lets the reader report the missing file
+        return self._open_member(xml_files[0])
+
+    @property
+    def epidemic_type(self):
+        """
+        Whether the epidemic is 'generalized' or 'concentrated', as read from
+        the EPP sub-populations.
+        """
+        if self._epidemic_type is None:
+            self.epp('subpops')
+        return self._epidemic_type
 
     def epp(self, table):
         """
         Uses the R package SpecIO, developed at Imperial, to import some of the
-        data from the Spectrum file.
-        """
-
-        # Details the R functions available and tables of data they export.
-        epp_functions = {
-            "read_epp_data": [
-                'anc.prev',
-                'anc.n',
-                'ancrtsite.prev',
-                'ancrtsite.n',
-                'hhs'
-            ],
-            "read_epp_subpops": [
-                'subpops',
-                'turnover'
-            ]
-        }
+        data from the Spectrum file. R is started on the first call. The
+        native backend reads the same tables without R.
+        """
 
-        # Utility function to convert an R matrix into a pandas dataframe
-        def r2df(r_matrix):
-            dataframe = pandas2ri.ri2py_dataframe(r_matrix)
-            dataframe.columns = r_matrix.colnames
-            dataframe.index = r_matrix.rownames
-            return dataframe
+        epp_functions = PJNZFile.epp_functions
 
         # Determines the R function to call, given the requested table
         def get_function(table):
-            for function, tables in epp_functions.iteritems():
+            for function, tables in epp_functions.items():
                 if table in tables:
                     return function
 
@@ -99,76 +413,146 @@ class PJNZFile():
             # Import data for every table we are interested in
             # Data is stratified into groups which we have to combine.
             # Groups are either regions or sub-populations depending on epidemic type.
-            epp_data = r['read_epp_data'](self.fpath)
+            if self.epp_backend == 'native':
+                self.epp_data.update(epp_reader.read_epp_data(self._epp_source()))
+                return
+
+            r = specio.r
+            epp_data = r['read_epp_data'](self.local_path)
             for table_name in epp_functions[function]:
-                complete_data = {}
-                for group in epp_data.names:
-                    try:
-                        data_frame = r2df(epp_data.rx2(group).rx2(table_name))
-                        data_frame = data_frame.astype(float)
-                        data_frame['Group'] = group
-                        complete_data[group] = data_frame
-                    except TypeError:
-                        pass  # Only get the data if it exists
-
-                if complete_data.values():
-                    self.epp_data[table_name] = pandas.concat(complete_data.values())
-                else:
-                    self.epp_data[table_name] = None
+                # Only get the data if it exists
+                data_frame, groups = specio.combine_groups(epp_data, table_name)
+                if data_frame is not None:
+                    data_frame = data_frame.astype(float)
+                    data_frame['Group'] = groups
+                self.epp_data[table_name] = data_frame
 
         # Combines data for each group into one complete data set.
         def read_epp_subpops():
-            epp_subpops = r['read_epp_subpops'](self.fpath)
-            pops_data = {}
+            if self.epp_backend == 'native':
+                tables, self._epidemic_type = epp_reader.read_epp_subpops(self._epp_source())
+                self.epp_data.update(tables)
+                return
+
+            r = specio.r
+            epp_subpops = r['read_epp_subpops'](self.local_path)
             turnover_data = {}
-            self.epidemic_type = r['attr'](epp_subpops, 'epidemicType')[0]
+            self._epidemic_type = r['attr'](epp_subpops, 'epidemicType')[0]
 
-            for group in epp_subpops.rx2('subpops').names:
-                try:
-                    # Get the population data
-                    data_frame = r2df(epp_subpops.rx2('subpops').rx2(group))
-                    data_frame['Group'] = group
-                    pops_data[group] = data_frame
-                except TypeError:
-                    pass  # Only get the data if it exists
+            # Get the population data, if it exists
+            data_frame, groups = specio.combine_groups(epp_subpops.rx2('subpops'))
+            if data_frame is not None:
+                data_frame['Group'] = groups
+            self.epp_data['subpops'] = data_frame
 
+            for group in epp_subpops.rx2('subpops').names:
                 try:
                     # Get the turnover data
                     duration = r['attr'](
                         epp_subpops.rx2('subpops').rx2(group),
                         'duration'
                     )[0]
-                    if type(duration) is NALogicalType:
-                        duration = numpy.NaN
+                    if specio.is_na(duration):
+                        duration = numpy.nan
                     turnover_data[group] = pandas.DataFrame({group: duration}, index=['Duration'])
                 except TypeError:
                     pass  # Only get the data if it exists
 
-            if pops_data.values():
-                self.epp_data['subpops'] = pandas.concat(pops_data.values())
-            else:
-                self.epp_data['subpops'] = None
-
             if turnover_data.values():
                 self.epp_data['turnover'] = pandas.concat(turnover_data.values(), axis='columns')
             else:
                 self.epp_data['turnover'] = None
 
-        # Only import if we havn't already done so.
-        if self.epp_data.get(table, None) is None:
-            # Call the relavent R function to get the data
-            function = get_function(table)
-            locals()[function]()
+        # Loads all tables exported by an R function from the cache, if present.
+        def load_from_cache(function):
+            cached_data = {}
+            for table_name in epp_functions[function]:
+                found, data, extra = self.cache.get(
+                    self.file_hash,
+                    self.cache.key('epp', self.epp_backend, table_name)
+                )
+                if not found:
+                    return False
+                cached_data[table_name] = data
+                if 'epidemic_type' in extra:
+                    self._epidemic_type = extra['epidemic_type']
+            self.epp_data.update(cached_data)
+            return True
+
+        # Stores all tables exported by an R function in the cache.
+        def save_to_cache(function):
+            for table_name in epp_functions[function]:
+                extra = {}
+                if table_name == 'subpops':
+                    extra['epidemic_type'] = self._epidemic_type
+                self.cache.put(
+                    self.file_hash,
+                    self.cache.key('epp', self.epp_backend, table_name),
+                    self.epp_data[table_name],
+                    **extra
+                )
+
+        # Only import if we havn't already done so - tables found not to
+        # exist are stored as None, so these aren't looked for again either.
+        # Check again once locked, another thread may have imported it.
+        if table not in self.epp_data:
+            with self._epp_lock:
+                if table not in self.epp_data:
+                    if self.pjnz_file is None:
+                        raise ValueError("EPP table " + table + " isn't available")
+                    # Call the relavent R function to get the data, unless cached
+                    function = get_function(table)
+                    with instrumentation.span('epp', table=table, function=function,
+                                              backend=self.epp_backend) as span:
+                        if self.cache and load_from_cache(function):
+                            span.set(cache='hit')
+                        else:
+                            self._run_epp_read(locals()[function])
+                            if self.cache:
+                                span.set(cache='miss')
+                                save_to_cache(function)
+                        if self.epp_data[table] is not None:
+                            span.set(rows=len(self.epp_data[table]))
 
         # Return only the requested table
         return self.epp_data[table]
 
+    def _run_epp_read(self, read):
+        # Runs an EPP read on the epp_executor, unless already on its thread
+        if self.epp_executor is None or getattr(_epp_thread, 'active', False):
+            return read()
+
+        def run():
+            _epp_thread.active = True
+            try:
+                return read()
+            finally:
+                _epp_thread.active = False
+        return self.epp_executor.submit(instrumentation.bind(run)).result()
+
+    def epp_all(self):
+        """
+        Reads every EPP table, making at most one call to each SpecIO function.
+        Returns a dict of all the tables, with None for tables that don't exist.
+        """
+        for function, tables in PJNZFile.epp_functions.items():
+            self.epp(tables[0])
+
+        return {
+            table: self.epp_data[table]
+            for tables in PJNZFile.epp_functions.values()
+            for table in tables
+        }
+
     def dp(self, tag, type=None, columns=None):
         """
         Loads a dp table stored under the specified tag. Converts the
         table to the specified type and adds the specified columns. If type
         and columns arn't specified as arguments, it will look into the
         PJNZFile's dp_tables property for the relevant configurations.
+
+        Tables are shared with every other caller rather than copied, so
+        must not be modified.
         """
         # Setup some default values
         if not type:
@@ -176,22 +560,84 @@ class PJNZFile():
         if not columns:
             columns = self.dp_tables.get(tag, {}).get('columns', PJNZFile.default_columns)
 
-        # DP tables are cached in the dp_tables property alongside configs
+        # DP tables are cached in the dp_data property, keyed by their configs
         # Only extract table if needbe as it's computationally intensive
-        if self.dp_tables.get(tag, {}).get('data') is not None:
-            table = self.dp_tables[tag]['data']
-        else:
-            table = self.extract_dp_table(tag, type, columns)
-
-            # Cache the table
-            if not self.dp_tables.get(tag):
-                self.dp_tables[tag] = {}
-            self.dp_tables[tag]['data'] = table
-            self.dp_tables[tag]['type'] = type
-            self.dp_tables[tag]['columns'] = columns
+        data_key = (tag, type, tuple(columns))
+        table = self.dp_data.get(data_key)
+        if table is not None:
+            with instrumentation.span('dp', tag=tag, cache='memory'):
+                return table
+
+        # Check again once locked, another thread may have extracted it.
+        with self._lock:
+            table = self.dp_data.get(data_key)
+            if table is None:
+                with instrumentation.span('dp', tag=tag) as span:
+                    if self.cache:
+                        key = self.cache.key('dp', tag, getattr(type, '__name__', type), list(columns))
+                        found, table, extra = self.cache.get(self.file_hash, key)
+                        span.set(cache='miss' if table is None else 'hit')
+                    if table is None:
+                        table = self.extract_dp_table(tag, type, columns)
+                        if self.cache:
+                            self.cache.put(self.file_hash, key, table)
+                    span.set(rows=len(table))
+                self.dp_data[data_key] = table
 
         return table
 
+    def input_hash(self, key):
+        """
+        Returns a stable hash of the contents of one input to the tables
+        built from this file, or None if the input doesn't exist. Inputs are
+        keyed as "dp:<tag>" for the DP block under a tag, "epp:<table>" for
+        an EPP table, or "epidemic_type".
+        """
+        if key not in self.input_hashes:
+            kind, _, name = key.partition(':')
+            if kind == 'dp':
+                content = self._dp_content(name)
+            elif kind == 'epp':
+                content = PJNZFile._table_content(self.epp(name))
+            elif kind == 'epidemic_type':
+                content = json.dumps(self.epidemic_type).encode('utf-8')
+            else:
+                raise ValueError("Unknown input " + key)
+            self.input_hashes[key] = (
+                hashlib.sha1(content).hexdigest() if content is not None else None
+            )
+        return self.input_hashes[key]
+
+    def _dp_content(self, tag):
+        with self._lock:
+            if self.dataframes is None:
+                self._extract_files()
+        if not self.dp_index or "<" + tag + ">" not in self.dp_index:
+            return None
+        block = self._dp_block("<" + tag + ">")
+        return (
+            json.dumps([block.name, block.shape]).encode('utf-8') +
+            block.offsets.astype(numpy.int64).tobytes() + bytes(block.data)
+        )
+
+    @staticmethod
+    def _table_content(table):
+        # The values, index and column labels of a dataframe, as bytes
+        if table is None:
+            return None
+        row_hashes = pandas.util.hash_pandas_object(table, index=True).values
+        labels = json.dumps([str(c) for c in table.columns] + [str(d) for d in table.dtypes])
+        return row_hashes.tobytes() + labels.encode('utf-8')
+
+    def view(self, dp_tables=None, epp_data=None):
+        """
+        Returns a view of this file for building one table. The view reads
+        the same (shared) tables, but looks up dp() configurations in its own
+        dp_tables, and any derived epp_data set on it overlays the file's
+        tables without changing them.
+        """
+        return PJNZFileView(self, dp_tables, epp_data)
+
     def extract_dp_table(self, tag, type=float, columns=default_columns):
         """
         The DP file appears to be made up of a number of subsidary dataframes,
@@ -199,49 +645,223 @@ class PJNZFile():
         they are structured in the sheet, but this function broadly pulls
         out a subset of the DP sheet for a given tag.
         """
-        # Get the entire DP sheet with rows and columns indexed by numbers
-        dp_sheet = self.dataframes.get(self.fname + '.DP')
-        if dp_sheet is None:
+        with self._lock:
+            if self.dataframes is None:
+                self._extract_files()
+        if self.dp_index is None:
             raise FileNotFoundError("DP sheet not found")
-        dp_sheet.columns = range(0, len(dp_sheet.columns))
 
-        # Find desired tag in first column
+        # Look up the block of the desired tag in the tag index
         tag = "<" + str(tag) + ">"
-        try:
-            start_row = dp_sheet.index[dp_sheet[0] == tag].tolist()[0]
-        except IndexError:
+        if tag not in self.dp_index:
             raise ValueError(tag + " not found in DP sheet")
+        block = self._dp_block(tag)
 
-        # Find end tag that follows the desired tag
-        end_rows = dp_sheet.index[dp_sheet[0] == "<End>"].tolist()
-        for n in end_rows:
-            if n > start_row:
-                end_row = n
-                break
+        # Slice out the desired sub-table, padding or trimming the block to
+        # the number of columns.
+        width = len(columns)
+        cells = block.cells(width)
+        keep = [n for n, column in enumerate(columns) if column != "Drop"]
+        if len(keep) < width:
+            cells = cells[:, keep]
 
-        # Slice out the desired sub-table, and store the table name and tag.
-        dp_table = dp_sheet.copy().iloc[start_row+2:end_row, 3:]
-        dp_table.name = dp_sheet.iloc[start_row+1, 1]
+        # Convert the type of the data
+        try:
+            dp_table = PJNZFile._convert_to_type(
+                cells,
+                type,
+                index=range(block.start_row+2, block.end_row),
+                columns=[columns[n] for n in keep]
+            )
+        except Exception:
+            logging.error("Can't convert " + tag + " to " + str(type))
+            raise
+
+        # Store the table name and tag.
+        dp_table.name = block.name
         dp_table.tag = tag
 
-        # Drop empty columns at end of data, and assign column names to the data
-        dp_table = dp_table.drop(range(
-            len(columns)+3,
-            len(dp_table.columns)+3
-        ), axis='columns')
-        dp_table.columns = columns
-        if "Drop" in columns:
-            dp_table = dp_table.drop("Drop", 'columns')
+        return dp_table
 
-        # Convert the type of the data
-        if type:
-            try:
-                dp_table = PJNZFile._convert_to_type(dp_table, type)
-            except Exception:
-                logging.error("Can't convert " + tag + " to " + str(type))
-                raise
+    def _dp_block(self, tag):
+        """
+        Returns the DPBlock stored under a (bracketed) tag, with its cells
+        decoded. In lazy mode blocks are decoded from the raw DP sheet on
+        demand.
+        """
+        block = self.dp_index[tag]
+        if block.data is None:
+            with self._lock:
+                if block.data is None:
+                    rows = [
+                        row for row in PJNZFile._csv_reader(
+                            io.BytesIO(self.dp_buffer[block.start:block.end])
+                        )
+                        if not PJNZFile._blank_row(row)
+                    ]
+                    block.name = rows[0][1] if rows and len(rows[0]) > 1 else None
+                    block.pack([row[3:] for row in rows[1:]])
+        return block
+
+    def drop_dp_sheet(self):
+        """
+        Decodes every DP block not yet decoded, then frees the raw DP sheet
+        kept in lazy mode, unmapping it if it was spilled. Only the compact
+        blocks are kept from then on.
+        """
+        with self._lock:
+            if self.dataframes is None:
+                self._extract_files()
+            for tag in self.dp_index or {}:
+                self._dp_block(tag)
+            self.dp_buffer = None
+            for member_map in self._mmaps:
+                member_map.close()
+            self._mmaps = []
 
-        return dp_table
+    @staticmethod
+    def _in_memory_buffer(fpath):
+        """
+        Returns the bytes of a PJNZ file given as bytes, a bytearray,
+        memoryview or binary file object, or None if fpath is a path. Bytes
+        are used as they are, and are only a path under Python 2, where
+        paths are bytes. A bytearray or memoryview is copied once, as the
+        zip file is read from an immutable copy.
+        """
+        if isinstance(fpath, bytes) and bytes is not str:
+            return fpath
+        if isinstance(fpath, (bytearray, memoryview)):
+            return bytes(fpath)
+        if hasattr(fpath, 'read'):
+            return fpath.read()
+        if not isinstance(fpath, (str, type(u''))):
+            raise TypeError(
+                "A PJNZ file must be a path, bytes, bytearray, memoryview or "
+                "binary file object, not " + type(fpath).__name__
+            )
+        return None
+
+    @staticmethod
+    def _member_fname(pjnz_file):
+        """
+        Finds the file name shared by the members of a PJNZ file, from its
+        DP sheet.
+        """
+        for name in pjnz_file.namelist():
+            if name.endswith('.DP'):
+                return os.path.basename(name)[:-3]
+        raise ValueError("DP sheet not found in PJNZ")
+
+    @staticmethod
+    def _csv_reader(file_object, delimiter=','):
+        """
+        Returns a csv reader over a binary file object of utf-8 text.
+        """
+        if sys.version_info[0] >= 3:
+            file_object = io.TextIOWrapper(file_object, encoding='utf-8', newline='')
+        return csv.reader(file_object, delimiter=delimiter)
+
+    @staticmethod
+    def _blank_row(cells):
+        # Blank and whitespace only lines are skipped, as read_csv skips them
+        return not cells or (len(cells) == 1 and cells[0].isspace())
+
+    @staticmethod
+    def _index_dp_buffer(buffer, delimiter=b','):
+        """
+        Indexes the raw bytes of the DP sheet without parsing its cells. Only
+        the first cell of each line is looked at. Returns a DPBlock for each
+        tag, holding the rows it spans and the byte offsets of the block from
+        the table name row up to the closing <End> row. Names and cells are
+        decoded later, by _dp_block.
+        """
+        index = {}
+        open_tags = []
+        offset = 0
+        row = 0
+
+        # Only the first cell of each line is copied out of the buffer, so
+        # memory mapped sheets are never read into memory as a whole.
+        while offset < len(buffer):
+            line_end = buffer.find(b'\n', offset)
+            line_end = len(buffer) if line_end == -1 else line_end + 1
+            cell_end = buffer.find(delimiter, offset, line_end)
+            first_cell = buffer[offset:line_end if cell_end == -1 else cell_end]
+            if cell_end == -1 and not first_cell.strip():
+                offset = line_end  # Blank lines aren't rows, see _blank_row
+                continue
+            first_cell = first_cell.rstrip(b'\r\n').strip(b'"')
+
+            if first_cell == b"<End>":
+                for tag in open_tags:
+                    index[tag].end_row = row
+                    index[tag].end = offset
+                open_tags = []
+            elif first_cell.startswith(b"<"):
+                tag = first_cell.decode('utf-8')
+                if tag not in index:
+                    index[tag] = DPBlock(row, line_end)
+                    open_tags.append(tag)
+
+            offset = line_end
+            row += 1
+
+        # Tags never closed by an <End> tag can't be sliced out of the sheet
+        for tag in open_tags:
+            del index[tag]
+
+        return index
+
+    @staticmethod
+    def _read_dp_sheet(file_object, delimiter=','):
+        """
+        Streams the DP sheet line by line, splitting it into tagged blocks
+        as it goes. Only the data cells (4th column onwards) of the rows in
+        each block are kept, packed into the block once it closes.
+        Returns a DPBlock for each tag, holding the row it first appears on,
+        the row of the first <End> tag that follows it and the table name
+        stored in the row below the tag.
+        """
+        index = {}
+        open_tags = []  # Each open tag, with the rows read into it so far
+        named_tag = None
+
+        with file_object as f:
+            row = -1
+            for cells in PJNZFile._csv_reader(f, delimiter):
+                if PJNZFile._blank_row(cells):
+                    continue
+                row += 1
+                first_cell = cells[0]
+
+                # The table name lives in the row below the tag
+                if named_tag is not None:
+                    index[named_tag].name = cells[1] if len(cells) > 1 else None
+                    named_tag = None
+
+                if first_cell == "<End>":
+                    for tag, rows in open_tags:
+                        index[tag].end_row = row
+                        index[tag].pack(rows)
+                    open_tags = []
+                    continue
+
+                # Data starts two rows below the tag, so nested tags and their
+                # names are data of the blocks around them.
+                for tag, rows in open_tags:
+                    if row >= index[tag].start_row + 2:
+                        rows.append(cells[3:])
+
+                if first_cell.startswith("<") and first_cell not in index:
+                    index[first_cell] = DPBlock(row)
+                    open_tags.append((first_cell, []))
+                    named_tag = first_cell
+
+        # Tags never closed by an <End> tag can't be sliced out of the sheet
+        for tag, rows in open_tags:
+            del index[tag]
+
+        return index
 
     @staticmethod
     def _add_delimiters(file_object, delimiter=','):
@@ -251,24 +871,113 @@ class PJNZFile():
         it matches the longest row in length.  All empty cells will be assigned NaN if the Pandas
         dataframe.
         """
-        s_data = ''
+        lines = []
         max_num_delimiters = 0
+        delimiter = delimiter.encode('utf-8')
 
         with file_object as f:
             for line in f:
-                s_data += line
+                lines.append(line)
                 delimiter_count = line.count(delimiter)
                 if delimiter_count > max_num_delimiters:
                     max_num_delimiters = delimiter_count
 
-        s_delimiters = delimiter * max_num_delimiters + '\n'
+        s_delimiters = delimiter * max_num_delimiters + b'\n'
 
-        return io.StringIO(unicode(s_delimiters + s_data, "utf-8"))
+        return io.StringIO((s_delimiters + b''.join(lines)).decode("utf-8"))
 
     @staticmethod
-    def _convert_to_type(df, type):
-        # Do an NaN safe data type conversion
-        df = df.fillna(-99999999)
-        df = df.astype(type)
-        df = df.replace(-99999999, numpy.nan)
-        return df
+    def _convert_to_type(cells, type, index, columns):
+        """
+        Does an NaN safe conversion of an array of strings into a dataframe
+        of the given type, parsing each cell once. Empty cells become NaN,
+        except in int columns, which become nullable Int64 columns so that
+        the rest of the data stays integer. If type is None the strings are
+        kept as they are.
+        """
+        missing = cells == ''
+        if type:
+            values = numpy.where(missing, '0', cells).astype(type)
+        else:
+            values = cells.astype(object)
+
+        # The converted values are wrapped, not copied, by the dataframe
+        if not missing.any():
+            return pandas.DataFrame(values, index=index, columns=columns, copy=False)
+
+        if values.dtype.kind not in 'iu':
+            values[missing] = numpy.nan
+            return pandas.DataFrame(values, index=index, columns=columns, copy=False)
+
+        data = {}
+        for n in range(values.shape[1]):
+            if missing[:, n].any():
+                data[n] = pandas.arrays.IntegerArray(values[:, n], missing[:, n])
+            else:
+                data[n] = values[:, n]
+        dp_table = pandas.DataFrame(data, index=index, columns=range(values.shape[1]))
+        dp_table.columns = columns
+        return dp_table
+
+
+class PJNZFileView(object):
+    """
+    A view of a PJNZFile with its own dp() configurations and derived EPP
+    tables, so that many tables can be built from one shared PJNZFile at
+    once. Everything else is read from the underlying file.
+    """
+
+    def __init__(self, pjnz_file, dp_tables=None, epp_data=None):
+        self.pjnz = pjnz_file
+        self.dp_tables = dp_tables or {}
+        self.epp_data = EPPDataOverlay(pjnz_file.epp_data, epp_data or {})
+
+    def dp(self, tag, type=None, columns=None):
+        """
+        Loads a dp table from the underlying file, using this view's
+        dp_tables for any configuration not specified as an argument.
+        """
+        return self.pjnz.dp(
+            tag,
+            type or self.dp_tables.get(tag, {}).get('type'),
+            columns or self.dp_tables.get(tag, {}).get('columns')
+        )
+
+    def epp(self, table):
+        """
+        Loads an epp table, preferring tables derived on this view.
+        """
+        if dict.__contains__(self.epp_data, table):
+            return self.epp_data[table]
+        return self.pjnz.epp(table)
+
+    def view(self, dp_tables=None, epp_data=None):
+        merged_dp_tables = dict(self.dp_tables)
+        merged_dp_tables.update(dp_tables or {})
+        merged_epp_data = dict(self.epp_data)  # Only the derived tables
+        merged_epp_data.update(epp_data or {})
+        return PJNZFileView(self.pjnz, merged_dp_tables, merged_epp_data)
+
+    def __getattr__(self, name):
+        return getattr(self.pjnz, name)
+
+
+class EPPDataOverlay(dict):
+    """
+    A dict of derived EPP tables, that falls back to (without modifying) a
+    base dict of the tables read from a PJNZ file. Only the derived tables
+    are iterated over.
+    """
+
+    def __init__(self, base, overlay):
+        dict.__init__(self, overlay)
+        self.base = base
+
+    def __missing__(self, key):
+        return self.base[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.base
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
@@ -0,0 +1,138 @@
+"""
+A registry of the validation schemas used to build a package. The package
+schema and the schema directory are loaded once per process, and each
+resource's python_class is resolved to a shared SchemedTable builder.
+"""
+from adx_lib.dependencies import table_inputs
+from collections import OrderedDict
+from io import open
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import threading
+
+
+class SchemaRegistry(object):
+    """
+    Loads a package schema and every table schema in a directory, and builds
+    one SchemedTable per package resource with a python_class. The table
+    builders don't change once loaded, so they can be shared between files,
+    threads and (once pickled) processes.
+    """
+
+    def __init__(self, package_schema_path, schemas_directory):
+        self.package_schema_path = package_schema_path
+        self.schemas_directory = schemas_directory
+        with open(package_schema_path, encoding='utf-8') as read_file:
+            self.package_schema = json.load(read_file)
+
+        # Load every table schema in the directory, keyed by file name
+        self.schemas = {}
+        for fname in sorted(os.listdir(schemas_directory)):
+            if fname.endswith('.json'):
+                with open(os.path.join(schemas_directory, fname), encoding='utf-8') as read_file:
+                    self.schemas[fname[:-5]] = json.load(read_file)
+
+        # Build a table for each resource, in package order, noting the
+        # inputs each is built from and a hash of how it is built.
+        self.tables = OrderedDict()
+        self.inputs = {}
+        self.table_hashes = {}
+        self._plan = None
+        for resource in self.package_schema['resources']:
+            if not resource.get('python_class'):
+                continue
+            validator_schema = next(
+                f for f in resource['resource_fields']
+                if f.get('field_name', '') == 'validator_schema'
+            )['field_value']
+            table_class = resolve_class(resource['python_class'])
+            self.tables[resource['name']] = table_class(
+                os.path.join(schemas_directory, validator_schema + '.json'),
+                schema=self.schemas[validator_schema]
+            )
+            self.inputs[resource['name']] = table_inputs(self.tables[resource['name']])
+            self.table_hashes[resource['name']] = table_hash(
+                resource['python_class'], self.tables[resource['name']]
+            )
+
+    def table(self, resource_name):
+        """
+        Returns the SchemedTable that builds the named resource.
+        """
+        return self.tables[resource_name]
+
+    def plan(self):
+        """
+        Returns the PackagePlan of the inputs to extract for every table.
+        """
+        if self._plan is None:
+            from adx_lib.package_plan import PackagePlan
+            self._plan = PackagePlan(self)
+        return self._plan
+
+    def __iter__(self):
+        """
+        Iterates over (resource name, SchemedTable) pairs, in package order.
+        """
+        return iter(self.tables.items())
+
+    def __len__(self):
+        return len(self.tables)
+
+
+def resolve_class(python_class):
+    """
+    Imports the class named by python_class, e.g.
+    "adx_lib.spectrum_tables.ARTTable".
+    """
+    module_name, class_name = python_class.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def table_hash(python_class, schemed_table):
+    """
+    Returns a hash of how a SchemedTable is built: its python_class, schema
+    and declared inputs, and the source code of its class and base classes
+    where it can be found.
+    """
+    sources = []
+    for cls in inspect.getmro(type(schemed_table)):
+        if cls is object:
+            continue
+        try:
+            sources.append(inspect.getsource(cls))
+        except (IOError, OSError, TypeError):
+            sources.append(cls.__module__ + '.' + cls.__name__)
+    return hashlib.sha1(json.dumps([
+        python_class,
+        schemed_table.schema,
+        schemed_table.dp_tables,
+        sorted(schemed_table.epp_tables),
+        bool(schemed_table.uses_epidemic_type),
+        sources
+    ], sort_keys=True, default=_type_name).encode('utf-8')).hexdigest()
+
+
+def _type_name(value):
+    # dp_tables configure types, e.g. float, which json can't serialise
+    return getattr(value, '__name__', str(value))
+
+
+# Registries already loaded in this process
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(package_schema_path, schemas_directory):
+    """
+    Returns the SchemaRegistry for a package schema and schema directory,
+    loading it only the first time it is asked for in this process.
+    """
+    key = (os.path.abspath(package_schema_path), os.path.abspath(schemas_directory))
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = SchemaRegistry(package_schema_path, schemas_directory)
+        return _registries[key]
@@ -2,6 +2,24 @@ import json
 import pandas as pd
 from collections import OrderedDict
 from io import open
+from adx_lib import instrumentation
+
+# Compiled spectrum_file_key snippets, keyed by their source code. Code
+# objects can't be pickled, so they are kept here rather than on instances.
+_compiled_snippets = {}
+
+
+def compile_snippet(source):
+    """
+    Compiles a python snippet from a JSON schema into a code object that can
+    be passed to eval, reusing the code object if the snippet has already
+    been compiled.
+    """
+    code = _compiled_snippets.get(source)
+    if code is None:
+        code = compile(source, '<spectrum_file_key>', 'eval')
+        _compiled_snippets[source] = code
+    return code
 
 
 class SchemedTable:
@@ -10,32 +28,107 @@ class SchemedTable:
     used by our validator extension to check the data upon upload.
     """
 
-    def __init__(self, fpath):
+    # The file formats tables can be written in. Each format maps to its file
+    # extension, a writer (table, binary stream) and a reader (path or stream).
+    # Parquet and feather (Arrow IPC) keep column dtypes but need pyarrow.
+    file_formats = {
+        'csv': (
+            '.csv',
+            lambda table, f: SchemedTable.write_csv(table, f),
+            lambda f: pd.read_csv(f, encoding='utf-8')
+        ),
+        'parquet': (
+            '.parquet',
+            lambda table, f: table.to_parquet(f, index=False),
+            lambda f: pd.read_parquet(f)
+        ),
+        'feather': (
+            '.feather',
+            lambda table, f: table.reset_index(drop=True).to_feather(f),
+            lambda f: pd.read_feather(f)
+        )
+    }
+
+    # The inputs a table reads from a Spectrum File besides those named in
+    # its schema: dp() configurations by tag, EPP tables, and whether it
+    # depends on the epidemic type. Used to work out a table's dependencies.
+    dp_tables = {}
+    epp_tables = []
+    uses_epidemic_type = False
+
+    def __init__(self, fpath, schema=None):
+        """
+        Loads the schema at fpath, unless the already loaded schema is given.
+        """
         self.fname = fpath.split('/')[-1][:-5]  # fName w/o path or extension
-        with open(fpath, encoding='utf-8') as read_file:
-            self.schema = json.load(read_file)
+        if schema is None:
+            with open(fpath, encoding='utf-8') as read_file:
+                schema = json.load(read_file)
+        self.schema = schema
+
+        # Reindex foreign key and enum information so it is more easily accessible
+        self.foreign_keys = {v['fields']: v for v in self.schema.get('foreignKeys', [])}
+        self.enums = {
+            f['name']: f['constraints']['enum']
+            for f in self.schema.get('fields', [])
+            if 'enum' in f.get('constraints', {})
+        }
+
+        # Templates built so far, keyed by the info flag they were built with
+        self._templates = {}
+
+        # Compile the python snippets in the schema once, up front. Broken
+        # snippets are reported when the table is built.
+        for field in self.schema.get('fields', []):
+            if field.get('spectrum_file_key'):
+                try:
+                    compile_snippet(field['spectrum_file_key'])
+                except SyntaxError:
+                    pass
 
     def create_template(self, info=True):
         """
-        Creates a template dataframe from the JSON schema.
+        Creates a template dataframe from the JSON schema. The template is
+        only built once per schema, each caller gets its own copy.
+        """
+        template = self._templates.get(info)
+        if template is None:
+            template = self._build_template(info)
+            self._templates[info] = template
+        return template.copy()
+
+    def create_empty_table(self):
+        """
+        Creates a table with the schema's columns but no rows, e.g. for tables
+        that don't apply to a Spectrum File's epidemic type.
         """
+        template = self._templates.get('empty')
+        if template is None:
+            template = self._build_template(info=False).iloc[1:]
+            self._templates['empty'] = template
+        return template.copy()
 
-        # Reindex foreign key information so it is more easily accessible
+    def _build_template(self, info):
+        """
+        Builds a template dataframe from the JSON schema, without modifying
+        the schema.
+        """
         data = OrderedDict()
-        foreign_keys = {v['fields']: v for v in self.schema.get('foreignKeys', [])}
+        foreign_keys = self.foreign_keys
 
         # Create the csv template column by column
         for f in self.schema['fields']:
             # We'll build a column of information about the data field
             info_values = []
             if info:
-                # Pop enum out of constraints as we treat this seperately
-                enum = f.get('constraints', {}).pop('enum', [])
+                # Enum constraints are treated seperately
+                enum = self.enums.get(f['name'], [])
 
                 # State basic field constraints
                 info_values = ["", "--conditions--", "type: "+str(f['type'])]
-                for k, v in f.get('constraints', {}).iteritems():
-                    info_values += [str(k)+": "+str(v)]
+                for k, v in f.get('constraints', {}).items():
+                    if k != 'enum':
+                        info_values += [str(k)+": "+str(v)]
 
                 # List possible values if enum field
                 if enum:
@@ -57,10 +150,10 @@ class SchemedTable:
                     info_values += ["", "--composite key--"]
 
             # Insert sample data, or else the conditions assembled above
-            data[f['name']] = [f['name']]+map(str, f.get(
+            data[f['name']] = [f['name']] + [str(v) for v in f.get(
                 'example_values',
                 info_values
-            ))
+            )]
 
         template = pd.DataFrame.from_dict(data, orient='index').transpose()
 
@@ -70,32 +163,87 @@ class SchemedTable:
 
         return template
 
-    def create_csv_template(self, fname=None, directory="."):
+    def create_csv_template(self, fname=None, directory=".", stream=None):
         """
-        Creates a csv template from the GoodTables schema.
+        Creates a csv template from the GoodTables schema. The template is
+        written straight to the binary stream if one is given, otherwise to a
+        file in the directory.
         """
+        template = self.create_template()
+        if stream is not None:
+            SchemedTable.write_csv(template, stream, header=False)
+            return
+
         if fname is None:
             fname = self.fname + "_template.csv"
-        template = self.create_template()
-        file = open(directory+"/"+fname, "w")
-        file.write(unicode(template.to_csv(header=False, index=False)))
-        file.close()
+        with open(directory+"/"+fname, "wb") as file:
+            SchemedTable.write_csv(template, file, header=False)
 
     def create_table(self, spectrum_file):
         """
         This function should be overriden by sub-classes. It should create
         a table from the schema and populate it with data from a Spectrum File.
         """
-        return self.create_template(info=False).iloc[1:]
+        return self.create_empty_table()
 
-    def create_csv_table(self, spectrum_file, fname=None, directory='.'):
+    def create_csv_table(self, spectrum_file, fname=None, directory='.', stream=None):
         """
-        Creates a csv table from the GoodTables schema.
+        Creates a csv table from the GoodTables schema. The table is written
+        straight to the binary stream if one is given, otherwise to a file in
+        the directory. Returns the path of the csv file, if one was written.
         """
-        if fname is None:
-            fname = self.fname + "_" + spectrum_file.country + ".csv"
-        table = self.create_table(spectrum_file)
-        file = open(directory+"/"+fname, "w")
-        csv_table = table.to_csv(header=True, index=False, encoding='utf-8')
-        file.write(unicode(csv_table, encoding='utf-8'))
-        file.close()
+        return self.create_table_file(spectrum_file, 'csv', fname, directory, stream)
+
+    def create_table_file(self, spectrum_file, format='csv', fname=None,
+                          directory='.', stream=None):
+        """
+        Creates a table file from the GoodTables schema, in any of the
+        file_formats. The table is written straight to the binary stream if
+        one is given, otherwise to a file in the directory. Returns the path
+        of the file, if one was written.
+        """
+        extension, write, read = SchemedTable.file_formats[format]
+        with instrumentation.span('create table', table=self.fname) as span:
+            table = self.create_table(spectrum_file)
+            span.set(rows=len(table))
+
+        with instrumentation.span('write', table=self.fname, format=format) as span:
+            span.set(rows=len(table))
+            if stream is not None:
+                span.set(bytes=write(table, stream))
+                return None
+
+            if fname is None:
+                fname = self.fname + "_" + spectrum_file.country + extension
+            with open(directory+"/"+fname, "wb") as file:
+                write(table, file)
+                span.set(bytes=file.tell())
+        return directory+"/"+fname
+
+    @staticmethod
+    def write_csv(table, stream, header=True, chunksize=1000):
+        """
+        Writes a dataframe to a binary stream as utf-8 csv, a chunk of rows at
+        a time, so the full csv text is never held in memory. Returns the
+        number of bytes written.
+        """
+        written = 0
+        for start in range(0, max(len(table), 1), chunksize):
+            csv_chunk = table.iloc[start:start+chunksize].to_csv(
+                header=header and start == 0,
+                index=False,
+                encoding='utf-8'
+            )
+            if not isinstance(csv_chunk, bytes):
+                csv_chunk = csv_chunk.encode('utf-8')
+            stream.write(csv_chunk)
+            written += len(csv_chunk)
+        return written
+
+    @staticmethod
+    def read_table_file(path_or_stream, format='csv'):
+        """
+        Reads a table file created by create_table_file back into a dataframe.
+        """
+        extension, write, read = SchemedTable.file_formats[format]
+        return read(path_or_stream)
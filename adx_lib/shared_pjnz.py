@@ -0,0 +1,223 @@
+"""
+Shares the tables parsed from one PJNZ file with worker processes through
+shared memory, so that one parse of a file feeds many table building
+processes without pickling any tables. This module needs Python 3.8 or later.
+
+The publishing process copies the file's decoded DP blocks and the numeric
+columns of its EPP tables into one shared memory segment, and hands its
+workers a small, picklable descriptor of the segment. Each worker attaches
+to the segment as a SharedPJNZFile, whose blocks and EPP columns are read
+only views of the segment rather than copies.
+
+    with SharedTables(pjnz) as shared:
+        pool = multiprocessing.Pool(initializer=attach, initargs=(shared.descriptor,))
+        ...
+
+    def attach(descriptor):
+        global pjnz
+        pjnz = SharedPJNZFile.attach(descriptor)
+"""
+from multiprocessing import shared_memory
+import logging
+
+import numpy
+import pandas
+
+from adx_lib.pjnz_file import PJNZFile, DPBlock
+
+# Arrays are placed in the segment at multiples of this many bytes
+_ALIGNMENT = 16
+
+
+class SharedTables(object):
+    """
+    Publishes the DP blocks and EPP tables of a PJNZFile into a shared memory
+    segment. The segment is removed by close(), which must only be called
+    once every worker is done with it.
+    """
+
+    def __init__(self, pjnz, dp_tags=None, epp_tables=None):
+        """
+        Every DP block and EPP table is published, or only the blocks under
+        the given dp_tags and the given epp_tables - e.g. those planned by a
+        PackagePlan. The epidemic type is published if the subpops table is.
+        EPP tables that can't be read are left out, for the tables needing
+        them to report.
+        """
+        blocks = decoded_blocks(pjnz, dp_tags)
+        if epp_tables is None:
+            epp_tables = [t for tables in PJNZFile.epp_functions.values() for t in tables]
+        tables = {}
+        for table in epp_tables:
+            try:
+                tables[table] = pjnz.epp(table)
+            except Exception as e:
+                logging.debug("Can't publish " + table + ": " + str(e))
+
+        # Lay out every array in the segment before copying any
+        arrays = []
+        dp = {}
+        for tag, block in blocks.items():
+            dp[tag] = (
+                block.name, block.start_row, block.end_row, block.shape,
+                _add(arrays, numpy.frombuffer(block.data, dtype=numpy.uint8)),
+                _add(arrays, block.offsets)
+            )
+        epp = {}
+        for table, data in tables.items():
+            epp[table] = None if data is None else _table_descriptor(arrays, data)
+        size = arrays[-1][1] + arrays[-1][0].nbytes if arrays else 0
+
+        # Segments can't be empty
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            for array, offset in arrays:
+                _view(self.shared_memory, (offset, array.dtype.str, array.shape))[...] = array
+        except Exception:
+            self.close()
+            raise
+
+        self.descriptor = {
+            'name': self.shared_memory.name,
+            'fpath': pjnz.fpath,
+            'fname': pjnz.fname,
+            'country': pjnz.country,
+            'epidemic_type': pjnz._epidemic_type if 'subpops' in tables else None,
+            'dp': dp,
+            'epp': epp
+        }
+
+    def close(self):
+        """
+        Closes and removes the shared memory segment.
+        """
+        if self.shared_memory is not None:
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.shared_memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SharedPJNZFile(PJNZFile):
+    """
+    A read only PJNZFile attached to the tables published by SharedTables in
+    another process. dp() tables are converted from the shared DP blocks as
+    usual, while epp() tables share their numeric columns with the segment,
+    so must not be modified. DP blocks and EPP tables that weren't published
+    can't be read.
+
+    The segment is only unmapped by close() once no table viewing it is
+    left, or else when the process exits.
+    """
+
+    @classmethod
+    def attach(cls, descriptor):
+        """
+        Attaches to the tables published under a SharedTables descriptor.
+        """
+        # Pool workers share the publishing process's resource tracker, so
+        # the segment isn't removed when a worker attached to it exits.
+        segment = shared_memory.SharedMemory(name=descriptor['name'])
+
+        dp_blocks = {}
+        for tag, (name, start_row, end_row, shape, data, offsets) in descriptor['dp'].items():
+            block = DPBlock(start_row)
+            block.name = name
+            block.end_row = end_row
+            block.shape = shape
+            block.data = _view(segment, data, read_only=True)
+            block.offsets = _view(segment, offsets, read_only=True)
+            dp_blocks[tag] = block
+
+        epp_data = dict(
+            (table, None if spec is None else _attach_table(segment, spec))
+            for table, spec in descriptor['epp'].items()
+        )
+
+        pjnz = cls.from_tables(
+            descriptor['fname'], dp_blocks, epp_data,
+            epidemic_type=descriptor['epidemic_type'],
+            fpath=descriptor['fpath'],
+            country=descriptor['country']
+        )
+        pjnz.shared_memory = segment
+        return pjnz
+
+    def close(self):
+        """
+        Drops the shared tables and unmaps the segment, unless tables viewing
+        it are still held elsewhere.
+        """
+        PJNZFile.close(self)
+        self.dp_index = {}
+        self.dp_data = {}
+        self.epp_data = {}
+        try:
+            self.shared_memory.close()
+        except BufferError:
+            logging.debug("Shared tables of " + self.fname + " are still in use")
+
+
+def decoded_blocks(pjnz, dp_tags=None):
+    """
+    Returns the decoded DPBlocks of a PJNZFile, keyed by their bracketed
+    tags - all of them, or only those under the given (unbracketed) tags.
+    """
+    with pjnz._lock:
+        if pjnz.dataframes is None:
+            pjnz._extract_files()
+    index = pjnz.dp_index or {}
+    if dp_tags is None:
+        tags = list(index)
+    else:
+        tags = ["<" + tag + ">" for tag in dp_tags if "<" + tag + ">" in index]
+    return dict((tag, pjnz._dp_block(tag)) for tag in tags)
+
+
+def _add(arrays, array):
+    # Places an array after those already in the segment's layout, returning
+    # its spec: its offset in the segment, its dtype and its shape
+    array = numpy.ascontiguousarray(array)
+    offset = 0
+    if arrays:
+        end = arrays[-1][1] + arrays[-1][0].nbytes
+        offset = -(-end // _ALIGNMENT) * _ALIGNMENT
+    arrays.append((array, offset))
+    return (offset, array.dtype.str, array.shape)
+
+
+def _view(segment, spec, read_only=False):
+    # Returns the array with the given spec in the segment, without copying
+    offset, dtype, shape = spec
+    array = numpy.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset)
+    if read_only:
+        array.flags.writeable = False
+    return array
+
+
+def _table_descriptor(arrays, table):
+    # Numeric columns are published, while the others (e.g. group names)
+    # and the index are small enough to be pickled with the descriptor
+    columns = []
+    for n in range(table.shape[1]):
+        values = table.iloc[:, n].values
+        if isinstance(values, numpy.ndarray) and values.dtype.kind in 'biuf':
+            columns.append(('shared', _add(arrays, values)))
+        else:
+            columns.append(('pickled', values))
+    return {'columns': list(table.columns), 'index': table.index, 'values': columns}
+
+
+def _attach_table(segment, spec):
+    data = dict(
+        (n, _view(segment, values, read_only=True) if kind == 'shared' else values)
+        for n, (kind, values) in enumerate(spec['values'])
+    )
+    table = pandas.DataFrame(data, index=spec['index'], columns=range(len(data)), copy=False)
+    table.columns = spec['columns']
+    return table
@@ -0,0 +1,109 @@
+"""
+The embedded R session used to read EPP data with Imperial's SpecIO package.
+R is only started the first time it is needed (or when explicitly warmed), so
+importing adx_lib stays cheap for processes that never read EPP data.
+"""
+import threading
+
+
+class SpecIOEngine(object):
+    """
+    Lazily starts R and loads SpecIO. Packages are never installed here -
+    SpecIO must already be installed in R, e.g. with
+    devtools::install_github('mrc-ide/specio').
+    """
+
+    # Binds a named list of per-group matrices or data frames (or the named
+    # table within each group) into a single data frame in R, so that every
+    # group is converted to pandas in one step.
+    combine_groups_source = """
+    function(x, table = NULL) {
+        if (!is.null(table)) x <- lapply(x, function(group) group[[table]])
+        x <- Filter(Negate(is.null), x)
+        if (!length(x)) return(list())
+        parts <- lapply(unname(x), function(part) {
+            part <- as.data.frame(part, stringsAsFactors = FALSE, optional = TRUE)
+            rownames(part) <- NULL
+            part
+        })
+        list(
+            data = do.call(rbind, parts),
+            columns = colnames(x[[1]]),
+            rownames = unlist(lapply(x, function(part) {
+                if (is.null(rownames(part))) as.character(seq_len(NROW(part)))
+                else rownames(part)
+            }), use.names = FALSE),
+            groups = rep(names(x), sapply(parts, nrow))
+        )
+    }
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._robjects = None
+        self._pandas2ri = None
+        self._na_logical_type = None
+        self._combine_groups = None
+
+    def start(self):
+        """
+        Starts R and loads SpecIO, if not already done. Call this to warm the
+        engine up front, e.g. in a worker process initialiser.
+        """
+        with self._lock:
+            if self._robjects is None:
+                from rpy2 import robjects
+                from rpy2.robjects import packages, pandas2ri
+                from rpy2.rinterface import NALogicalType
+
+                if not packages.isinstalled('specio'):
+                    raise ImportError(
+                        "The SpecIO R package is not installed. Install it in R "
+                        "with devtools::install_github('mrc-ide/specio')"
+                    )
+                packages.importr('specio')
+                pandas2ri.activate()
+
+                self._pandas2ri = pandas2ri
+                self._na_logical_type = NALogicalType
+                self._combine_groups = robjects.r(SpecIOEngine.combine_groups_source)
+                self._robjects = robjects
+        return self
+
+    @property
+    def started(self):
+        return self._robjects is not None
+
+    @property
+    def r(self):
+        return self.start()._robjects.r
+
+    @property
+    def pandas2ri(self):
+        return self.start()._pandas2ri
+
+    def combine_groups(self, groups, table=None):
+        """
+        Converts a named R list of per-group matrices or data frames - or the
+        named table within each group - into a single pandas dataframe.
+        Returns the dataframe and a list of the group each row came from, or
+        (None, None) if no group holds any data.
+        """
+        combined = self.start()._combine_groups(
+            groups,
+            table if table is not None else self._robjects.NULL
+        )
+        if not len(combined):
+            return None, None
+
+        data_frame = self._pandas2ri.ri2py_dataframe(combined.rx2('data'))
+        data_frame.columns = list(combined.rx2('columns'))
+        data_frame.index = list(combined.rx2('rownames'))
+        return data_frame, list(combined.rx2('groups'))
+
+    def is_na(self, value):
+        return type(value) is self.start()._na_logical_type
+
+
+# The engine shared by every PJNZFile in this process
+engine = SpecIOEngine()
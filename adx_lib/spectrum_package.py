@@ -0,0 +1,277 @@
+"""
+Builds whole Spectrum packages - one csv file per resource in the package
+schema - from PJNZ files. Many PJNZ files can be built at once across a pool
+of worker processes.
+"""
+from collections import namedtuple
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+from adx_lib import instrumentation
+from adx_lib.schema_registry import get_registry
+
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
+
+# The outcome of building one resource table from one PJNZ file.
+# fpath is the csv file written, or None if the build failed with error.
+TableResult = namedtuple('TableResult', ['pjnz_path', 'resource', 'fpath', 'error'])
+
+# Results queue shared with the pool, and the pid of the worker that took
+# each task, set in each worker by _init_worker
+_results = None
+_workers = None
+
+# The PJNZ file shared with the pool, set in each worker by _init_shared_worker
+_shared_pjnz = None
+
+
+def build_spectrum_packages(pjnz_paths, package_schema_path, schemas_directory,
+                            directory='.', processes=None, pjnz_kwargs=None):
+    """
+    Builds the Spectrum package for each PJNZ file across a pool of worker
+    processes, writing each package to its own sub-directory named after
+    the PJNZ file. Each worker owns one embedded R interpreter and builds
+    every table of a PJNZ file from a single PJNZFile instance. If a worker
+    dies, e.g. from a crash in R, the tables of the file it was building
+    that weren't yet reported fail with an error.
+
+    This is a generator - a TableResult is yielded as each table finishes.
+    """
+    registry = get_registry(package_schema_path, schemas_directory)
+    tasks = []
+    for pjnz_path in pjnz_paths:
+        package_name = os.path.splitext(os.path.basename(pjnz_path))[0]
+        package_directory = os.path.join(directory, package_name)
+        if not os.path.exists(package_directory):
+            os.makedirs(package_directory)
+        tasks.append((
+            pjnz_path, package_directory, package_schema_path,
+            schemas_directory, pjnz_kwargs or {}
+        ))
+
+    warm_r = (pjnz_kwargs or {}).get('epp_backend', 'specio') == 'specio'
+    results = multiprocessing.Queue()
+    # The pid of the worker that took each task, written as soon as it does
+    workers = multiprocessing.Array('i', len(tasks))
+    pool = multiprocessing.Pool(processes, _init_worker, (results, workers, warm_r))
+    try:
+        pending = pool.map_async(_build_package, list(enumerate(tasks)), chunksize=1)
+        reported = set()
+        remaining = len(tasks) * len(registry)
+        while remaining:
+            try:
+                index, result = results.get(timeout=1)
+            except Empty:
+                if pending.ready():
+                    pending.get()  # Re-raises any unexpected worker error
+                # The pool never finishes a task whose worker died
+                for result in _lost_results(tasks, workers, registry, reported):
+                    remaining -= 1
+                    yield result
+                continue
+            if (index, result.resource) in reported:
+                continue  # Already failed, as its worker died
+            reported.add((index, result.resource))
+            remaining -= 1
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def build_package_tables(pjnz, registry, directory='.', threads=None):
+    """
+    Builds every resource table in the registry from one loaded PJNZFile,
+    across a pool of threads that share the file. Everything the tables
+    need is extracted up front, as planned by the registry.
+
+    This is a generator - a TableResult is yielded as each table finishes.
+    """
+    pjnz_path = pjnz.fpath or pjnz.fname
+    registry.plan().execute(pjnz)
+
+    def build_table(resource):
+        name, schemed_table = resource
+        try:
+            fpath = schemed_table.create_csv_table(pjnz, directory=directory)
+            return TableResult(pjnz_path, name, fpath, None)
+        except Exception as e:
+            logging.exception("Failed to build " + name + " from " + pjnz_path)
+            return TableResult(pjnz_path, name, None, str(e))
+
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        for result in pool.imap_unordered(instrumentation.bind(build_table), list(registry)):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def build_shared_package_tables(pjnz, registry, directory='.', processes=None):
+    """
+    Builds every resource table in the registry from one loaded PJNZFile,
+    across a pool of worker processes. The DP blocks and EPP tables planned
+    by the registry (all of them, if any table couldn't be planned) are
+    parsed once and published in shared memory, which each worker attaches
+    to - see shared_pjnz. Needs Python 3.8 or later.
+
+    This is a generator - a TableResult is yielded as each table finishes.
+    """
+    from adx_lib.shared_pjnz import SharedTables
+    pjnz_path = pjnz.fpath or pjnz.fname
+    plan = registry.plan()
+    if plan.unplanned:
+        shared = SharedTables(pjnz)
+    else:
+        shared = SharedTables(pjnz, plan.dp_requests, plan.epp_tables)
+
+    tasks = [
+        (pjnz_path, name, directory, registry.package_schema_path, registry.schemas_directory)
+        for name in registry.tables
+    ]
+    try:
+        pool = multiprocessing.Pool(processes, _init_shared_worker, (shared.descriptor,))
+        try:
+            for result in pool.imap_unordered(_build_shared_table, tasks):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shared.close()
+
+
+def rebuild_package_tables(pjnz, registry, manifest=None, directory='.'):
+    """
+    Builds only the tables in the registry whose inputs, schema or table
+    class changed since the build recorded in manifest - e.g. when a
+    revised PJNZ file is uploaded. Tables whose inputs can't be worked out,
+    or which failed to build last time, are always rebuilt. With no
+    manifest, every table is built.
+
+    Returns a TableResult for each table built, and the manifest of this
+    build, a json-able dict to pass in to the next rebuild.
+    """
+    manifest = manifest or {'inputs': {}, 'tables': {}}
+    pjnz_path = pjnz.fpath or pjnz.fname
+    inputs = {}
+    tables = {}
+    results = []
+
+    for name, schemed_table in registry:
+        table_inputs = registry.inputs[name]
+        for key in table_inputs or []:
+            if key not in inputs:
+                inputs[key] = pjnz.input_hash(key)
+
+        previous = manifest['tables'].get(name)
+        if table_inputs is not None and previous and not previous['error'] \
+                and previous['hash'] == registry.table_hashes[name] \
+                and all(key in manifest['inputs'] for key in table_inputs) \
+                and all(manifest['inputs'][key] == inputs[key] for key in table_inputs):
+            tables[name] = previous
+            continue
+
+        try:
+            fpath = schemed_table.create_csv_table(pjnz, directory=directory)
+            result = TableResult(pjnz_path, name, fpath, None)
+        except Exception as e:
+            logging.exception("Failed to build " + name + " from " + pjnz_path)
+            result = TableResult(pjnz_path, name, None, str(e))
+        results.append(result)
+        tables[name] = {
+            'hash': registry.table_hashes[name],
+            'fpath': result.fpath,
+            'error': result.error
+        }
+
+    return results, {'inputs': inputs, 'tables': tables}
+
+
+def _lost_results(tasks, workers, registry, reported):
+    """
+    Yields an error TableResult for each unreported table of every task
+    taken by a worker process that has since died.
+    """
+    alive = set(process.pid for process in multiprocessing.active_children())
+    for index, pid in enumerate(workers[:]):
+        if not pid or pid in alive:
+            continue
+        pjnz_path = tasks[index][0]
+        for name in registry.tables:
+            if (index, name) not in reported:
+                reported.add((index, name))
+                yield TableResult(
+                    pjnz_path, name, None,
+                    "The worker process building " + pjnz_path + " died"
+                )
+
+
+def _init_worker(results, workers, warm_r):
+    global _results, _workers
+    _results = results
+    _workers = workers
+
+    # Starting R in the worker gives each process its own embedded R
+    if warm_r:
+        from adx_lib.specio_engine import engine
+        engine.start()
+
+
+def _build_package(task):
+    """
+    Builds every resource table for one PJNZ file, reporting each table's
+    result on the results queue along with the task's index. Exactly one
+    result is reported per table, even if the PJNZ file itself can't be
+    opened.
+    """
+    from adx_lib.pjnz_file import PJNZFile
+    index, (pjnz_path, directory, package_schema_path, schemas_directory, pjnz_kwargs) = task
+    _workers[index] = os.getpid()
+
+    # The schemas are only loaded by the first task each worker runs
+    registry = get_registry(package_schema_path, schemas_directory)
+
+    try:
+        pjnz = PJNZFile(pjnz_path, **pjnz_kwargs)
+    except Exception as e:
+        logging.exception("Failed to open " + pjnz_path)
+        for name, schemed_table in registry:
+            _results.put((index, TableResult(pjnz_path, name, None, str(e))))
+        return
+
+    registry.plan().execute(pjnz)
+    for name, schemed_table in registry:
+        try:
+            fpath = schemed_table.create_csv_table(pjnz, directory=directory)
+            _results.put((index, TableResult(pjnz_path, name, fpath, None)))
+        except Exception as e:
+            logging.exception("Failed to build " + name + " from " + pjnz_path)
+            _results.put((index, TableResult(pjnz_path, name, None, str(e))))
+
+
+def _init_shared_worker(descriptor):
+    global _shared_pjnz
+    from adx_lib.shared_pjnz import SharedPJNZFile
+    _shared_pjnz = SharedPJNZFile.attach(descriptor)
+
+
+def _build_shared_table(task):
+    """
+    Builds one resource table from the PJNZ file shared with this worker.
+    """
+    pjnz_path, name, directory, package_schema_path, schemas_directory = task
+    schemed_table = get_registry(package_schema_path, schemas_directory).table(name)
+    try:
+        fpath = schemed_table.create_csv_table(_shared_pjnz, directory=directory)
+        return TableResult(pjnz_path, name, fpath, None)
+    except Exception as e:
+        logging.exception("Failed to build " + name + " from " + pjnz_path)
+        return TableResult(pjnz_path, name, None, str(e))
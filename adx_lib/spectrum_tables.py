@@ -1,5 +1,8 @@
 from collections import OrderedDict
-from schemed_table import SchemedTable
+from adx_lib.schemed_table import SchemedTable, compile_snippet
+from adx_lib import instrumentation
+from adx_lib.pjnz_file import PJNZFile
+import json
 import pandas
 import numpy as np
 import pandas as pd
@@ -10,6 +13,117 @@ import logging
 from datetime import datetime
 
 
+def resolve_mappings(spectrum_file, fields):
+    """
+    Resolves the declarative spectrum_file_mapping of each field into a block
+    of data with one row per field. A mapping names its source table, either
+    {"dp": tag} or {"epp": table name}, and either the "row" or "column" of
+    that table to take, by position or label. Optionally it may also give a
+    "filter" of {column: value} to select rows, a list of "columns" to keep
+    and a "scale" to multiply the values by, e.g.
+
+        {"dp": "HAARTBySex MV", "row": 0}
+        {"epp": "combined_anc", "column": "2000", "filter": {"Type": "ANC-SS (%)"}}
+
+    Fields that read a table in the same way are resolved together, with a
+    single vectorised slice of the table. If a group of fields can't be
+    resolved the error is logged and only its rows are left empty (NaN).
+    """
+    # Group together the fields that read the same table in the same way
+    groups = OrderedDict()
+    for position, field in enumerate(fields):
+        mapping = field['spectrum_file_mapping']
+        kind = 'row' if 'row' in mapping else 'column'
+        key = (
+            'dp' if 'dp' in mapping else 'epp',
+            mapping['dp'] if 'dp' in mapping else mapping['epp'],
+            kind,
+            json.dumps(mapping.get('filter'), sort_keys=True),
+            json.dumps(mapping.get('columns'))
+        )
+        groups.setdefault(key, []).append((position, mapping[kind], mapping.get('scale')))
+
+    # Slice out the data for each group of fields
+    slices = []
+    for (source, name, kind, filter, columns), members in groups.items():
+        try:
+            with instrumentation.span('field mapping', source=source, table=name,
+                                      fields=len(members)) as span:
+                values = _slice_table(spectrum_file, source, name, kind,
+                                      json.loads(filter), json.loads(columns), members)
+                span.set(rows=values.shape[0], columns=values.shape[1])
+            slices.append((members, values))
+        except Exception as e:
+            logging.error(
+                "Failed to resolve spectrum_file_mapping for " +
+                ", ".join(fields[p]['name'] for p, selector, s in members) +
+                " => " + str(e)
+            )
+
+    # Assemble every slice into a single preallocated block
+    length = max([values.shape[1] for members, values in slices] or [0])
+    numeric = all(values.dtype.kind in 'biuf' for members, values in slices)
+    block = np.full((len(fields), length), np.nan, dtype=float if numeric else object)
+    for members, values in slices:
+        block[[p for p, selector, s in members], :values.shape[1]] = values
+        for position, selector, scale in members:
+            if scale is not None:
+                block[position] *= scale
+
+    return block
+
+
+def _slice_table(spectrum_file, source, name, kind, filter, columns, members):
+    # Slices the rows or columns selected by a group of mappings out of
+    # their table, as an array with one row per member
+    if source == 'dp':
+        table = spectrum_file.dp(name)
+    elif name in spectrum_file.epp_data:
+        table = spectrum_file.epp_data[name]
+    else:
+        table = spectrum_file.epp(name)
+
+    if filter:
+        mask = np.ones(len(table), dtype=bool)
+        for column, value in filter.items():
+            mask &= (table[column] == value).values
+        table = table[mask]
+    if columns:
+        table = table[columns]
+
+    data = _table_values(table)
+    if kind == 'row':
+        rows = [_label_position(table.index, row) for p, row, s in members]
+        return data[rows]
+    columns = [_label_position(table.columns, column) for p, column, s in members]
+    return data[:, columns].T
+
+
+def _table_values(table):
+    # Nullable (e.g. Int64) columns would make .values an object array, so
+    # tables using them are converted to floats, with NaN for missing values
+    dtypes = list(table.dtypes)
+    nullable = any(isinstance(d, pd.api.extensions.ExtensionDtype) for d in dtypes)
+    if nullable and all(pd.api.types.is_numeric_dtype(d) for d in dtypes):
+        return table.astype(float).values
+    return table.values
+
+
+def _fit_columns(block, length):
+    # Pads a block with NaN, or trims it, to the given number of columns
+    if block.shape[1] >= length:
+        return block[:, :length]
+    padding = np.full((block.shape[0], length - block.shape[1]), np.nan, dtype=block.dtype)
+    return np.concatenate([block, padding], axis=1)
+
+
+def _label_position(labels, selector):
+    # Integer selectors are positions, anything else is a label
+    if isinstance(selector, int):
+        return selector
+    return labels.get_loc(selector)
+
+
 def build_spectrum_table(spectrum_file, schema, index=None, **kwargs):
         """
         This function factorises out common code required to auto-populate
@@ -17,27 +131,53 @@ def build_spectrum_table(spectrum_file, schema, index=None, **kwargs):
         validation schema to build a dataframe and insert into it data from
         the PJNZ file.
 
+        Fields with a declarative spectrum_file_mapping are resolved together
+        by resolve_mappings. If every field has one, the resolved block is
+        used as the table as it is.
+
         IMPORTANT - This function evaluates snippets of code from the JSON
         schemas. This is not ideal, as the snippets would ideally be brought
         into the Python ecosystem. However, for the time being it was seen as
         the cleanest way to store the complex mapping of data from PJNZ to ADR
-        resource.
+        resource. Declarative mappings are preferred for new fields.
         """
         # We reference the spectrum file from json schemas - give it a shorthand ref
         sf = spectrum_file
 
-        # Remove the first schema field as this is the header/index
-        schema = schema.copy()
-        first_field = schema['fields'].pop(0)
+        # The first schema field is the header/index
+        first_field = schema['fields'][0]
+        fields = schema['fields'][1:]
+
+        # Resolve all declaratively mapped fields in one go
+        mapped_fields = [f for f in fields if f.get('spectrum_file_mapping')]
+        mapped_data = {}
+        if mapped_fields:
+            try:
+                block = resolve_mappings(spectrum_file, mapped_fields)
+                if kwargs.get('columns'):
+                    block = _fit_columns(block, len(kwargs['columns']))
+                mapped_data = OrderedDict(
+                    (f['name'], row) for f, row in zip(mapped_fields, block)
+                )
+            except Exception as e:
+                logging.error(
+                    "Failed to resolve spectrum_file_mappings for " +
+                    ", ".join(f['name'] for f in mapped_fields) + " => " + str(e)
+                )
 
         # Assemble the populated data file in dictionaries
         new_table = OrderedDict()
-        for field in schema['fields']:
-            if field.get('spectrum_file_key', False):
+        for field in fields:
+            if field['name'] in mapped_data:
+                new_table[field['name']] = mapped_data[field['name']]
+
+            elif field.get('spectrum_file_key', False):
                 # Fill row in with spectrum data
                 try:
                     # IMPORTANT - We evaluate a snippet of code from the JSON file
-                    data_series = list(eval(field['spectrum_file_key']))
+                    with instrumentation.span('field snippet', field=field['name']) as span:
+                        data_series = list(eval(compile_snippet(field['spectrum_file_key'])))
+                        span.set(rows=len(data_series))
                     new_table[field['name']] = data_series
 
                 except Exception as e:
@@ -58,21 +198,32 @@ def build_spectrum_table(spectrum_file, schema, index=None, **kwargs):
         else:
             length = max([len(x) for x in new_table.values()])
 
-        for key, value in new_table.iteritems():
+        for key, value in new_table.items():
             if len(value) == 0:
-                new_table[key] = [np.NaN]*length
-
-        new_table = pd.DataFrame.from_dict(
-            new_table,
-            **kwargs
-        )
+                new_table[key] = [np.nan]*length
+
+        if len(mapped_data) == len(fields) and set(kwargs) <= {'orient', 'columns'}:
+            # Every field was mapped, so the block already holds the table
+            if kwargs.get('orient') == 'index':
+                new_table = pd.DataFrame(
+                    block,
+                    index=list(mapped_data),
+                    columns=kwargs.get('columns')
+                )
+            else:
+                new_table = pd.DataFrame(block.T, columns=list(mapped_data))
+        else:
+            new_table = pd.DataFrame.from_dict(
+                new_table,
+                **kwargs
+            )
 
         # Fix the indicies if they are mannually specified
         if index:
             new_table.index = index
         # Fix the indicies if they are specified with a spectrum_file_key
         elif first_field.get('spectrum_file_key', False):
-            new_table.index = list(eval(first_field['spectrum_file_key']))
+            new_table.index = list(eval(compile_snippet(first_field['spectrum_file_key'])))
         new_table.insert(0, first_field['name'], new_table.index)
 
         return new_table
@@ -80,6 +231,8 @@ def build_spectrum_table(spectrum_file, schema, index=None, **kwargs):
 
 class SizeTable(SchemedTable):
 
+    epp_tables = ['subpops']
+
     def create_table(self, spectrum_file):
         """
         Conc Prevelance table is taken from the XML file, and loaded through
@@ -92,7 +245,7 @@ class SizeTable(SchemedTable):
         )
         subpops.columns = subpops.columns.astype(str)
         subpops['Group'] = subpops.index
-        spectrum_file.epp_data['subpops'] = subpops
+        spectrum_file = spectrum_file.view(epp_data={'subpops': subpops})
 
         return build_spectrum_table(
             spectrum_file,
@@ -102,6 +255,8 @@ class SizeTable(SchemedTable):
 
 class TurnoverTable(SchemedTable):
 
+    uses_epidemic_type = True
+
     def create_table(self, spectrum_file):
         """
         Conc Prevelance table is taken from the XML file, and loaded through
@@ -109,7 +264,7 @@ class TurnoverTable(SchemedTable):
         """
         # A generalised epidemic does not need this table filled in.
         if spectrum_file.epidemic_type == 'generalized':
-            return self.create_template(info=False).iloc[1:]
+            return self.create_empty_table()
         else:
             return build_spectrum_table(
                 spectrum_file,
@@ -133,6 +288,9 @@ class HHTable(SchemedTable):
 
 class ConcPrevalenceTable(SchemedTable):
 
+    epp_tables = ['anc.prev', 'anc.n']
+    uses_epidemic_type = True
+
     def create_table(self, spectrum_file):
         """
         ANC Prevelance table is taken from the XML file, and loaded through
@@ -143,12 +301,13 @@ class ConcPrevalenceTable(SchemedTable):
         """
         # A generalised epidemic does not need this table filled in.
         if spectrum_file.epidemic_type == 'generalized':
-            return self.create_template(info=False).iloc[1:]
+            return self.create_empty_table()
         else:
             # Use the SpecIO package to extrac epp model data.
+            # The tables are copied as they are shared with other tables.
             conc_prev = {
-                "prevalence": spectrum_file.epp('anc.prev'),
-                "N": spectrum_file.epp('anc.n')
+                "prevalence": spectrum_file.epp('anc.prev').copy(),
+                "N": spectrum_file.epp('anc.n').copy()
             }
 
             # Subset just the percentage columns and multiply by 100
@@ -159,17 +318,17 @@ class ConcPrevalenceTable(SchemedTable):
                 .loc[:, conc_prev["prevalence"].columns != 'Group']*100
 
             # Filtering out empty values and merging data types into one table
-            for key, value in conc_prev.iteritems():
+            for key, value in conc_prev.items():
                     value['Type'] = key
-            conc_prev = pandas.concat(conc_prev.values())
+            conc_prev = pandas.concat(list(conc_prev.values()))
             conc_prev['Site'] = conc_prev.index
 
             # Many values have been set to some huge negative figure.
             # Assume these should be empty?
-            tmp = conc_prev._get_numeric_data()
-            tmp[tmp < 0] = np.NaN
+            numeric = conc_prev.select_dtypes('number').columns
+            conc_prev[numeric] = conc_prev[numeric].mask(conc_prev[numeric] < 0)
 
-            spectrum_file.epp_data['conc_prev'] = conc_prev
+            spectrum_file = spectrum_file.view(epp_data={'conc_prev': conc_prev})
             return build_spectrum_table(
                 spectrum_file,
                 self.schema
@@ -178,6 +337,9 @@ class ConcPrevalenceTable(SchemedTable):
 
 class ANCPrevalenceTable(SchemedTable):
 
+    epp_tables = ['anc.prev', 'anc.n', 'ancrtsite.prev', 'ancrtsite.n']
+    uses_epidemic_type = True
+
     def create_table(self, spectrum_file):
         """
         ANC Prevelance table is taken from the XML file, and loaded through
@@ -194,15 +356,20 @@ class ANCPrevalenceTable(SchemedTable):
 
         # A concentrated epidemic does not need this table filled in.
         if spectrum_file.epidemic_type == 'concentrated':
-            return self.create_template(info=False).iloc[1:]
+            return self.create_empty_table()
         else:
             # Use the SpecIO package to extrac epp model data.
+            # The tables are copied as they are shared with other tables.
             combined_anc = {
                 "ANC-SS (%)": spectrum_file.epp('anc.prev'),
                 "ANC-SS (N)": spectrum_file.epp('anc.n'),
                 "ANC-RT (%)": spectrum_file.epp('ancrtsite.prev'),
                 "ANC-RT (N)": spectrum_file.epp('ancrtsite.n')
             }
+            combined_anc = {
+                k: v.copy() if v is not None else None
+                for k, v in combined_anc.items()
+            }
 
             # Subset just the percentage columns and multiply by 100
             # This gives percent rather than fraction.
@@ -217,17 +384,17 @@ class ANCPrevalenceTable(SchemedTable):
 
             # Filtering out empty values and merging data types into one table
             combined_anc = {k: v for k, v in combined_anc.items() if v is not None}
-            for key, value in combined_anc.iteritems():
+            for key, value in combined_anc.items():
                     value['Type'] = key
-            combined_anc = pandas.concat(combined_anc.values())
+            combined_anc = pandas.concat(list(combined_anc.values()))
             combined_anc['Site'] = combined_anc.index
 
             # Many values have been set to some huge negative figure.
             # Assume these should be empty?
-            tmp = combined_anc._get_numeric_data()
-            tmp[tmp < 0] = np.NaN
+            numeric = combined_anc.select_dtypes('number').columns
+            combined_anc[numeric] = combined_anc[numeric].mask(combined_anc[numeric] < 0)
 
-            spectrum_file.epp_data['combined_anc'] = combined_anc
+            spectrum_file = spectrum_file.view(epp_data={'combined_anc': combined_anc})
 
             return build_spectrum_table(
                 spectrum_file,
@@ -237,13 +404,15 @@ class ANCPrevalenceTable(SchemedTable):
 
 class ANCTestingTable(SchemedTable):
 
+    dp_tables = {
+        "ANCTestingValues MV": {
+            "type": float
+        }
+    }
+
     def create_table(self, spectrum_file):
 
-        spectrum_file.dp_tables = {
-            "ANCTestingValues MV": {
-                "type": float
-            }
-        }
+        spectrum_file = spectrum_file.view(dp_tables=self.dp_tables)
 
         return build_spectrum_table(
             spectrum_file,
@@ -255,13 +424,15 @@ class ANCTestingTable(SchemedTable):
 
 class BreastfeedingTable(SchemedTable):
 
+    dp_tables = {
+        "InfantFeedingOptions MV": {
+            "type": float
+        }
+    }
+
     def create_table(self, spectrum_file):
 
-        spectrum_file.dp_tables = {
-            "InfantFeedingOptions MV": {
-                "type": float
-            }
-        }
+        spectrum_file = spectrum_file.view(dp_tables=self.dp_tables)
         return build_spectrum_table(
             spectrum_file,
             self.schema,
@@ -272,14 +443,16 @@ class BreastfeedingTable(SchemedTable):
 
 class PMTCTTable(SchemedTable):
 
+    dp_tables = {
+        "ARVRegimen MV2": {
+            "type": float,
+            "columns": ["Drop"] + PJNZFile.default_columns
+        }
+    }
+
     def create_table(self, spectrum_file):
 
-        spectrum_file.dp_tables = {
-            "ARVRegimen MV2": {
-                "type": float,
-                "columns": ["Drop"] + spectrum_file.default_columns
-            }
-        }
+        spectrum_file = spectrum_file.view(dp_tables=self.dp_tables)
 
         # We only want to return a subset of the columns
         columns_to_keep = [self.schema['fields'][0]['name']]
@@ -296,22 +469,24 @@ class PMTCTTable(SchemedTable):
 
 class ARTTable(SchemedTable):
 
+    dp_tables = {
+        "HAARTBySex MV": {"type": float},
+        "MedianCD4 MV": {"type": float},
+        "PercLostFollowup MV": {"type": float},
+        "CD4ThreshHoldAdults MV": {"type": int},
+        "ChildARTCalc MV2": {"type": float},
+        "ChildTreatInputs MV3": {"type": float},
+        "PercLostFollowupChild MV": {"type": float},
+        "CD4ThreshHold MV": {"type": int},
+        "ChildNeedPMTCT MV": {"type": float},
+        "ChildOnPMTCT MV": {"type": float},
+        "NumNewARTPats MV": {"type": float},
+        "MedCD4CountInit MV": {"type": int}
+    }
+
     def create_table(self, spectrum_file):
 
-        spectrum_file.dp_tables = {
-            "HAARTBySex MV": {"type": float},
-            "MedianCD4 MV": {"type": float},
-            "PercLostFollowup MV": {"type": float},
-            "CD4ThreshHoldAdults MV": {"type": int},
-            "ChildARTCalc MV2": {"type": float},
-            "ChildTreatInputs MV3": {"type": float},
-            "PercLostFollowupChild MV": {"type": float},
-            "CD4ThreshHold MV": {"type": int},
-            "ChildNeedPMTCT MV": {"type": float},
-            "ChildOnPMTCT MV": {"type": float},
-            "NumNewARTPats MV": {"type": float},
-            "MedCD4CountInit MV": {"type": int}
-        }
+        spectrum_file = spectrum_file.view(dp_tables=self.dp_tables)
         return build_spectrum_table(
             spectrum_file,
             self.schema,
@@ -322,11 +497,13 @@ class ARTTable(SchemedTable):
 
 class CaseMortalityTable(SchemedTable):
 
+    dp_tables = {
+        "FitIncidence MV6": {"type": int}
+    }
+
     def create_table(self, spectrum_file):
 
-        spectrum_file.dp_tables = {
-            "FitIncidence MV6": {"type": int}
-        }
+        spectrum_file = spectrum_file.view(dp_tables=self.dp_tables)
         return build_spectrum_table(
             spectrum_file,
             self.schema,
@@ -337,11 +514,13 @@ class CaseMortalityTable(SchemedTable):
 
 class KnownStatusTable(SchemedTable):
 
+    dp_tables = {
+        "ViralSuppressionInput MV": {"type": int}
+    }
+
     def create_table(self, spectrum_file):
 
-        spectrum_file.dp_tables = {
-            "ViralSuppressionInput MV": {"type": int}
-        }
+        spectrum_file = spectrum_file.view(dp_tables=self.dp_tables)
         return build_spectrum_table(
             spectrum_file,
             self.schema,
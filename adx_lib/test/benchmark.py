@@ -0,0 +1,315 @@
+"""
+Benchmarks PJNZ parsing and table building on synthetic PJNZ files, so that
+regressions in the hot paths can be caught without any real Spectrum files.
+
+    python benchmark.py                          # Print timings
+    python benchmark.py --save-baseline base.json
+    python benchmark.py --baseline base.json     # Exits 1 on regressions
+
+Table building is only benchmarked if the package schema and the schema
+directory are given. EPP data is read with the native backend by default,
+so R isn't needed - pass --epp-backend specio to include SpecIO.
+"""
+from adx_lib.pjnz_file import PJNZFile
+from adx_lib.schema_registry import get_registry
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    timer = time.perf_counter
+except AttributeError:  # Python 2
+    timer = time.time
+
+# DP tags read by the tables in spectrum_tables, so that synthetic files can
+# be used to build every table. Tags read as ints only hold whole numbers.
+SPECTRUM_TAGS = [
+    "ANCTestingValues MV",
+    "InfantFeedingOptions MV",
+    "ARVRegimen MV2",
+    "HAARTBySex MV",
+    "MedianCD4 MV",
+    "PercLostFollowup MV",
+    "CD4ThreshHoldAdults MV",
+    "ChildARTCalc MV2",
+    "ChildTreatInputs MV3",
+    "PercLostFollowupChild MV",
+    "CD4ThreshHold MV",
+    "ChildNeedPMTCT MV",
+    "ChildOnPMTCT MV",
+    "NumNewARTPats MV",
+    "MedCD4CountInit MV",
+    "FitIncidence MV6",
+    "ViralSuppressionInput MV"
+]
+
+# The EPP groups (regions or sub-populations) written to synthetic files
+EPP_GROUPS = ['Urban', 'Rural', 'Mining', 'Fishing', 'Border', 'Capital']
+
+
+def make_synthetic_pjnz(fpath, tags=100, rows=20, years=56, groups=2,
+                        sites=10, seed=0):
+    """
+    Writes a synthetic PJNZ file to fpath, with a DP sheet of tagged blocks
+    (the SPECTRUM_TAGS plus enough made up tags to reach the given number of
+    tags, each holding rows by years of numbers) and an EPP xml file with
+    ANC, household survey and sub-population data for each group.
+    """
+    rng = random.Random(seed)
+    fname = os.path.basename(fpath)[:-5]
+    tag_names = SPECTRUM_TAGS[:tags]
+    tag_names += ["Synthetic{} MV".format(n) for n in range(tags - len(tag_names))]
+
+    with zipfile.ZipFile(fpath, 'w', zipfile.ZIP_DEFLATED) as pjnz_file:
+        pjnz_file.writestr(fname + '.DP', _synthetic_dp(tag_names, rows, years, rng))
+        pjnz_file.writestr(fname + '.xml', _synthetic_epp(groups, sites, rng))
+    return fpath
+
+
+def _synthetic_dp(tag_names, rows, years, rng):
+    lines = ['"<General>",Description,,' + ','.join(
+        str(1970 + n) for n in range(years)
+    )]
+    for tag in tag_names:
+        lines.append('"<' + tag + '>",,,')
+        lines.append(',"' + tag + ' table",,')
+        for row in range(rows):
+            # Leave the odd cell blank, as Spectrum does
+            cells = [
+                '' if rng.random() < 0.02 else str(rng.randint(0, 10000))
+                for year in range(years)
+            ]
+            lines.append(',,,' + ','.join(cells))
+        lines.append('"<End>",,,')
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def _synthetic_epp(groups, sites, rng):
+    start_year, end_year = 1970, 2021
+    num_years = end_year - start_year + 1
+
+    def value(tag, v):
+        return '<{0}>{1}</{0}>'.format(tag, v)
+
+    def prop(name, content):
+        return '<void property="{}">{}</void>'.format(name, content)
+
+    def array(tag, values, java_class='double'):
+        return '<array class="{}" length="{}">{}</array>'.format(
+            java_class, len(values), ''.join(
+                '<void index="{}">{}</void>'.format(n, value(tag, v))
+                for n, v in enumerate(values) if v
+            )
+        )
+
+    def matrix(scale):
+        return '<array class="[D" length="{}">{}</array>'.format(
+            sites, ''.join(
+                '<void index="{}">{}</void>'.format(n, array('double', [
+                    -1 if rng.random() < 0.3 else round(rng.random() * scale, 2)
+                    for year in range(1985, 2018)
+                ]))
+                for n in range(sites)
+            )
+        )
+
+    epp_sets = []
+    for group in EPP_GROUPS[:groups]:
+        surveys = [
+            (2000 + 5 * n, round(rng.random() * 30, 2), round(rng.random(), 2), rng.randint(1000, 10000))
+            for n in range(3)
+        ]
+        epp_sets.append('<void method="add"><object class="EPPSet">{}</object></void>'.format(''.join([
+            prop('name', value('string', group)),
+            prop('siteNames', array('string', [
+                '{} site {}'.format(group, n) for n in range(sites)
+            ], 'java.lang.String')),
+            prop('survData', matrix(40)),
+            prop('survSampleSizes', matrix(800)),
+            prop('siteANCRTPrevalence', matrix(40)),
+            prop('siteANCRTSampleSizes', matrix(800)),
+            prop('surveyYears', array('int', [s[0] for s in surveys], 'int')),
+            prop('surveyHIV', array('double', [s[1] for s in surveys])),
+            prop('surveyStandardError', array('double', [s[2] for s in surveys])),
+            prop('surveySampleSize', array('int', [s[3] for s in surveys], 'int')),
+            prop('surveyIsUsed', array('boolean', ['true'] * len(surveys), 'boolean')),
+            prop('pop15to49', array('double', [rng.randint(1, 10 ** 6) for y in range(num_years)])),
+            prop('pop15', array('double', [rng.randint(1, 10 ** 5) for y in range(num_years)])),
+            prop('pop50', array('double', [rng.randint(1, 10 ** 5) for y in range(num_years)])),
+            prop('netMigration', array('double', [rng.randint(0, 1000) for y in range(num_years)])),
+            prop('duration', value('double', rng.randint(5, 40)))
+        ])))
+
+    project = ''.join([
+        prop('worksetStartYear', value('int', start_year)),
+        prop('worksetEndYear', value('int', end_year)),
+        prop('epidemicType', '<object class="EpidemicType" field="GENERALIZED"/>'),
+        prop('eppSetChildren', '<object class="java.util.ArrayList">' + ''.join(epp_sets) + '</object>')
+    ])
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<java version="1.8.0" class="java.beans.XMLDecoder">'
+        '<object class="EPPProject">' + project + '</object></java>\n'
+    ).encode('utf-8')
+
+
+def measure(function, repeats=3, setup=None):
+    """
+    Calls function repeats times, returning the fastest time in seconds and
+    the largest peak of memory allocated in bytes (None if tracemalloc isn't
+    available). Memory is traced in separate runs, as tracing slows down
+    those it traces. If setup is given, it is called untimed and untraced
+    before each run, and function is passed what it returns.
+    """
+    def run(trace):
+        args = (setup(),) if setup else ()
+        gc.collect()
+        if trace:
+            tracemalloc.start()
+        start = timer()
+        function(*args)
+        duration = timer() - start
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return duration, peak
+
+    best_time = min(run(False)[0] for n in range(repeats))
+    peak_memory = None
+    if tracemalloc:
+        peak_memory = max(run(True)[1] for n in range(repeats))
+    return best_time, peak_memory
+
+
+def run_benchmarks(pjnz_path, registry=None, epp_backend='native', repeats=3):
+    """
+    Benchmarks each stage of building tables from the PJNZ file at
+    pjnz_path. Returns a dict of benchmark name to (seconds, peak bytes).
+    """
+    results = {}
+
+    def open_pjnz(**kwargs):
+        return PJNZFile(pjnz_path, country='Synthetic', epp_backend=epp_backend, **kwargs)
+
+    results['PJNZFile'] = measure(lambda: open_pjnz(), repeats)
+    results['PJNZFile lazy'] = measure(lambda: open_pjnz(lazy=True), repeats)
+
+    pjnz = open_pjnz(lazy=True)
+    tags = sorted(tag[1:-1] for tag in pjnz.dp_index if tag != '<General>')
+
+    # Later stages are given a newly opened file, so each times only itself
+    def extract_all(pjnz):
+        for tag in tags:
+            pjnz.extract_dp_table(tag)
+
+    results['extract_dp_table'] = measure(extract_all, repeats, open_pjnz)
+    results['extract_dp_table lazy'] = measure(
+        extract_all, repeats, lambda: open_pjnz(lazy=True)
+    )
+
+    def dp_all(pjnz):
+        for n in range(2):  # The second pass should hit the dp() cache
+            for tag in tags:
+                pjnz.dp(tag)
+
+    results['dp'] = measure(dp_all, repeats, open_pjnz)
+    results['epp_all'] = measure(
+        lambda pjnz: pjnz.epp_all(), repeats, lambda: open_pjnz(lazy=True)
+    )
+
+    if registry is not None:
+        for name, schemed_table in registry:
+            def create_table(pjnz):
+                try:
+                    schemed_table.create_table(pjnz)
+                except Exception as e:
+                    # Synthetic files may lack data a schema relies on
+                    print("Can't build {}: {}".format(name, e))
+            results['create_table ' + name] = measure(create_table, repeats, open_pjnz)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a baseline, returning a message for each benchmark
+    that is more than tolerance (a fraction) slower or larger than before.
+    """
+    regressions = []
+    for name, (seconds, peak) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base_seconds, base_peak = baseline[name]
+        if seconds > base_seconds * (1 + tolerance):
+            regressions.append("{}: {:.4f}s, was {:.4f}s".format(name, seconds, base_seconds))
+        if peak and base_peak and peak > base_peak * (1 + tolerance):
+            regressions.append("{}: {} bytes peak, was {}".format(name, peak, base_peak))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tags', type=int, default=100, help="DP tags per file")
+    parser.add_argument('--rows', type=int, default=20, help="Rows per DP tag")
+    parser.add_argument('--years', type=int, default=56, help="Years per DP row")
+    parser.add_argument('--groups', type=int, default=2, help="EPP groups per file")
+    parser.add_argument('--sites', type=int, default=10, help="ANC sites per EPP group")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--epp-backend', default='native')
+    parser.add_argument('--package-schema', help="Package schema to build tables for")
+    parser.add_argument('--schemas-directory', help="Directory of the table schemas")
+    parser.add_argument('--baseline', help="Baseline json to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Fraction slower than the baseline counted as a regression")
+    parser.add_argument('--save-baseline', help="Write the results to this json file")
+    args = parser.parse_args(argv)
+
+    registry = None
+    if args.package_schema and args.schemas_directory:
+        registry = get_registry(args.package_schema, args.schemas_directory)
+
+    directory = tempfile.mkdtemp()
+    try:
+        pjnz_path = make_synthetic_pjnz(
+            os.path.join(directory, 'Synthetic_benchmark.PJNZ'),
+            tags=args.tags,
+            rows=args.rows,
+            years=args.years,
+            groups=args.groups,
+            sites=args.sites
+        )
+        results = run_benchmarks(pjnz_path, registry, args.epp_backend, args.repeats)
+    finally:
+        shutil.rmtree(directory)
+
+    for name, (seconds, peak) in sorted(results.items()):
+        print("{:<40} {:>10.4f}s {:>14} bytes".format(name, seconds, peak or '-'))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+from adx_lib.pjnz_file import PJNZFile
+import io
+import os
+import pandas
+import sys
+
+"""
+This script checks the native EPP reader against SpecIO. It reads every EPP
+table from each PJNZ file given on the command line with both backends and
+reports any tables that differ.
+
+    python -m adx_lib.test.epp_parity path/to/file.PJNZ [...]
+
+With --save-expected, SpecIO's tables for a single PJNZ file are saved to a
+directory instead, as expected output for test_epp_reader, e.g.
+
+    python -m adx_lib.test.epp_parity --save-expected adx_lib/test/fixtures/Name_epp path/to/Name.PJNZ
+"""
+
+epp_tables = [
+    'subpops',
+    'turnover',
+    'anc.prev',
+    'anc.n',
+    'ancrtsite.prev',
+    'ancrtsite.n',
+    'hhs'
+]
+
+
+def compare_tables(expected, expected_type, pjnz):
+    """
+    Compares the EPP tables and epidemic type read from a PJNZFile with those
+    expected, printing each result. Returns the number of failures.
+    """
+    failures = 0
+
+    if expected_type != pjnz.epidemic_type:
+        print("  epidemic_type: " + str(expected_type) + " != " + str(pjnz.epidemic_type))
+        failures += 1
+
+    for table in epp_tables:
+        actual = pjnz.epp(table)
+        try:
+            if expected[table] is None or actual is None:
+                assert expected[table] is None and actual is None, "only one backend found the table"
+            else:
+                pandas.testing.assert_frame_equal(
+                    expected[table].sort_index(axis='columns'),
+                    actual.sort_index(axis='columns'),
+                    check_dtype=False,
+                    check_index_type=False
+                )
+            print("  " + table + ": OK")
+        except AssertionError as e:
+            print("  " + table + ": FAILED\n" + str(e))
+            failures += 1
+
+    return failures
+
+
+def compare_backends(pjnz_path):
+    specio = PJNZFile(pjnz_path, epp_backend='specio')
+    native = PJNZFile(pjnz_path, epp_backend='native')
+    expected = dict((table, specio.epp(table)) for table in epp_tables)
+    return compare_tables(expected, specio.epidemic_type, native)
+
+
+def save_expected(pjnz_path, directory):
+    """
+    Saves SpecIO's EPP tables and epidemic type for a PJNZ file to a
+    directory, one csv file per table that exists.
+    """
+    specio = PJNZFile(pjnz_path, epp_backend='specio')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for table in epp_tables:
+        if specio.epp(table) is not None:
+            specio.epp(table).to_csv(os.path.join(directory, table + '.csv'))
+    with io.open(os.path.join(directory, 'epidemic_type.txt'), 'w', encoding='utf-8') as f:
+        f.write(u'{}\n'.format(specio.epidemic_type))
+
+
+def read_expected(directory):
+    """
+    Reads the tables and epidemic type saved by save_expected. Returns a dict
+    of every EPP table, with None for those that don't exist, and the type.
+    """
+    expected = {}
+    for table in epp_tables:
+        path = os.path.join(directory, table + '.csv')
+        expected[table] = None
+        if os.path.exists(path):
+            expected[table] = pandas.read_csv(path, index_col=0)
+            expected[table].index = expected[table].index.astype(str)
+    with io.open(os.path.join(directory, 'epidemic_type.txt'), encoding='utf-8') as f:
+        epidemic_type = f.read().strip()
+    return expected, epidemic_type
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--save-expected']:
+        save_expected(sys.argv[3], sys.argv[2])
+        sys.exit(0)
+
+    failures = 0
+    for pjnz_path in sys.argv[1:]:
+        print(pjnz_path)
+        failures += compare_backends(pjnz_path)
+    sys.exit(1 if failures else 0)
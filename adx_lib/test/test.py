@@ -1,11 +1,10 @@
 from adx_lib.pjnz_file import PJNZFile
 from adx_lib import spectrum_tables
+from adx_lib.schema_registry import get_registry
 from rpy2.robjects.packages import importr
 from rpy2.robjects.vectors import StrVector
 from rpy2.robjects import r
 import numpy
-import json
-import importlib
 import os
 
 """
@@ -24,25 +23,12 @@ pjnz = PJNZFile(pjnz_directory+'Botswana_ 2019.PJNZ')
 def create_spectrum_package(pjnz_path, directory='.'):
     print("\n===" + directory + "===")
     pjnz = PJNZFile(pjnz_path)
-    with open(spectrum_schema_path) as json_file:
-        schema = json.load(json_file)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        for resource in schema['resources']:
-            print(resource['name'] + " - " + resource.get('python_class', 'No Python Class'))
-
-            validator_schema = filter(
-                lambda f: f.get('field_name', '') == 'validator_schema',
-                resource['resource_fields']
-            )[0]['field_value']
-
-            class_name = resource['python_class'].split('.')[-1]
-            module_name = '.'.join(resource['python_class'].split('.')[:-1])
-            imported_module = importlib.import_module(module_name)
-            imported_class = getattr(imported_module, class_name)
-            schemed_table = imported_class(schemas_directory + validator_schema + '.json')
-
-            schemed_table.create_csv_table(pjnz, directory=directory)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    registry = get_registry(spectrum_schema_path, schemas_directory)
+    for name, schemed_table in registry:
+        print(name + " - " + schemed_table.__class__.__name__)
+        schemed_table.create_csv_table(pjnz, directory=directory)
 
 
 spectrum_files = {
@@ -56,7 +42,7 @@ spectrum_files = {
     #'Mauritanie_2018': 'Mauritanie_2018_final_v5_65.PJNZ'
 }
 
-for k, v in spectrum_files.iteritems():
+for k, v in spectrum_files.items():
     create_spectrum_package(pjnz_directory+v, k)
 
 # subpops = r['read_epp_subpops'](pjnz_directory+'Mauritius_2018_shadow.PJNZ').rx2('subpops')
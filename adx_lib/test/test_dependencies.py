@@ -0,0 +1,66 @@
+"""
+Tests working out the inputs, and the types and columns of the DP blocks,
+a table is built from. Run from the repository root with
+
+    python -m pytest adx_lib/test
+"""
+from adx_lib.dependencies import dp_requests, snippet_inputs
+from adx_lib.pjnz_file import PJNZFile
+import unittest
+
+DEFAULT_COLUMNS = tuple(PJNZFile.default_columns)
+
+
+class Table(object):
+    """
+    Stands in for a SchemedTable with the given dp_tables and fields.
+    """
+
+    def __init__(self, fields, dp_tables=None):
+        self.dp_tables = dp_tables or {}
+        self.schema = {'fields': fields}
+
+
+class SnippetInputsTest(unittest.TestCase):
+
+    def test_dp_arguments(self):
+        snippets = {
+            "sf.dp('X').iloc[0]": (None, None),
+            "sf.dp('X', int)": (int, None),
+            "sf.dp('X', None, ['1970', '1971'])": (None, ['1970', '1971']),
+            "sf.dp('X', type=str, columns=sf.year_range)": (str, PJNZFile.year_range)
+        }
+        for source, arguments in snippets.items():
+            with self.subTest(source=source):
+                calls = []
+                self.assertEqual(snippet_inputs(source, calls), set(['dp:X']))
+                self.assertEqual(calls, [('X',) + arguments])
+
+    def test_unplanned_dp_arguments(self):
+        for source in ["sf.dp('X', t)", "sf.dp('X', float, years)",
+                       "sf.dp('X', float, ['1970', year])", "sf.dp('X', *arguments)",
+                       "sf.dp('X', **arguments)", "sf.dp('X', float, None, 1)"]:
+            with self.subTest(source=source):
+                self.assertIsNone(snippet_inputs(source, []))
+
+
+class DPRequestsTest(unittest.TestCase):
+
+    def test_configured_and_literal_types(self):
+        table = Table([
+            {'name': 'Configured', 'spectrum_file_key': "sf.dp('X').iloc[0]"},
+            {'name': 'Ints', 'spectrum_file_key': "sf.dp('X', int).iloc[1]"},
+            {'name': 'Mapped', 'spectrum_file_mapping': {'dp': 'Y', 'row': 0}}
+        ], dp_tables={'X': {'type': float, 'columns': ['1970']}})
+        self.assertEqual(dp_requests(table), {
+            'X': set([(float, ('1970',)), (int, ('1970',))]),
+            'Y': set([(float, DEFAULT_COLUMNS)])
+        })
+
+    def test_unplanned(self):
+        table = Table([{'name': 'A', 'spectrum_file_key': "sf.dp('X', float, years)"}])
+        self.assertIsNone(dp_requests(table))
+
+
+if __name__ == '__main__':
+    unittest.main()
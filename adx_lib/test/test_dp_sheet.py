@@ -0,0 +1,166 @@
+"""
+Regression tests for parsing the DP sheet of a PJNZ file into tables, in
+both eager and lazy mode. Run from the repository root with
+
+    python -m pytest adx_lib/test
+"""
+from adx_lib.pjnz_file import PJNZFile
+import io
+import numpy
+import pandas
+import unittest
+import zipfile
+
+# Rows are numbered from the <General> row, skipping blank lines as read_csv
+# did. Data starts two rows below each tag, so the rows of the nested
+# <Inner MV> block, from its tag on, are data of <Outer MV> too.
+DP_SHEET = '\r\n'.join([
+    '"<General>",Description,,1970,1971,1972',  # 0
+    '"<Flat MV>",,,',                            # 1
+    ',"Flat table",,',                           # 2
+    ',,,1,2.5,3',                                # 3
+    '',
+    '   ',
+    ',,,4,,6,99',                                # 4
+    '"<End>",,,',                                # 5
+    '"<Ints MV>",,,',                            # 6
+    ',"Ints table",,',                           # 7
+    ',,,1,,3',                                   # 8
+    ',,,,5,6',                                   # 9
+    '"<End>",,,',                                # 10
+    '"<Outer MV>",,,',                           # 11
+    ',"Outer table",,',                          # 12
+    ',,,1,2,3',                                  # 13
+    '"<Inner MV>",,,',                           # 14
+    ',"Inner, quoted",,',                        # 15
+    ',,,4,5,6',                                  # 16
+    '"<End>",,,',                                # 17
+    '"<Empty MV>",,,',                           # 18
+    ',"Empty table",,',                          # 19
+    '"<End>",,,',                                # 20
+    '"<Open MV>",,,',                            # 21
+    ',"Never closed",,',                         # 22
+    ',,,9'                                       # 23
+]) + '\r\n'
+
+YEARS = ['1970', '1971', '1972']
+
+
+def make_pjnz(dp_sheet=DP_SHEET):
+    """
+    Returns the bytes of a PJNZ file holding the given DP sheet, and an EPP
+    project without any data.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as pjnz_file:
+        pjnz_file.writestr('Test_2019.DP', dp_sheet)
+        pjnz_file.writestr('Test_2019.xml', '<java><object class="EPPProject"/></java>')
+    return bytearray(buffer.getvalue())
+
+
+class DPSheetTest(unittest.TestCase):
+
+    def pjnz_files(self):
+        data = make_pjnz()
+        for lazy in (False, True):
+            yield lazy, PJNZFile(data, epp_backend='native', lazy=lazy)
+
+    def assert_tables(self, tag, expected, name, **kwargs):
+        for lazy, pjnz in self.pjnz_files():
+            with self.subTest(tag=tag, lazy=lazy):
+                table = pjnz.extract_dp_table(tag, **kwargs)
+                pandas.testing.assert_frame_equal(table, expected)
+                self.assertEqual(table.name, name)
+                self.assertEqual(table.tag, '<' + tag + '>')
+
+    def test_flat_block(self):
+        # Blank lines are skipped, extra cells trimmed and empty cells are NaN
+        self.assert_tables('Flat MV', pandas.DataFrame(
+            [[1, 2.5, 3], [4, numpy.nan, 6]],
+            index=pandas.RangeIndex(3, 5),
+            columns=YEARS,
+            dtype=float
+        ), 'Flat table', type=float, columns=YEARS)
+
+    def test_padded_columns(self):
+        self.assert_tables('Flat MV', pandas.DataFrame(
+            [[1, 2.5, 3, numpy.nan, numpy.nan], [4, numpy.nan, 6, 99, numpy.nan]],
+            index=pandas.RangeIndex(3, 5),
+            columns=YEARS + ['1973', '1974'],
+            dtype=float
+        ), 'Flat table', type=float, columns=YEARS + ['1973', '1974'])
+
+    def test_dropped_columns(self):
+        self.assert_tables('Flat MV', pandas.DataFrame(
+            [[2.5, 3], [numpy.nan, 6]],
+            index=pandas.RangeIndex(3, 5),
+            columns=['1971', '1972'],
+            dtype=float
+        ), 'Flat table', type=float, columns=['Drop', '1971', '1972'])
+
+    def test_untyped_block(self):
+        # Built as the parser builds it, as pandas may infer a string dtype
+        self.assert_tables('Flat MV', pandas.DataFrame(
+            numpy.array([['1', '2.5', '3'], ['4', numpy.nan, '6']], dtype=object),
+            index=pandas.RangeIndex(3, 5),
+            columns=YEARS
+        ), 'Flat table', type=None, columns=YEARS)
+
+    def test_int_block_with_gaps(self):
+        # Only columns with gaps become nullable, the rest stay int
+        self.assert_tables('Ints MV', pandas.DataFrame(
+            {
+                '1970': pandas.array([1, None], dtype='Int64'),
+                '1971': pandas.array([None, 5], dtype='Int64'),
+                '1972': numpy.array([3, 6])
+            },
+            index=pandas.RangeIndex(8, 10)
+        ), 'Ints table', type=int, columns=YEARS)
+
+    def test_nested_blocks(self):
+        self.assert_tables('Outer MV', pandas.DataFrame(
+            [[1, 2, 3], [numpy.nan] * 3, [numpy.nan] * 3, [4, 5, 6]],
+            index=pandas.RangeIndex(13, 17),
+            columns=YEARS,
+            dtype=float
+        ), 'Outer table', type=float, columns=YEARS)
+        self.assert_tables('Inner MV', pandas.DataFrame(
+            [[4.0, 5.0, 6.0]],
+            index=pandas.RangeIndex(16, 17),
+            columns=YEARS
+        ), 'Inner, quoted', type=float, columns=YEARS)
+
+    def test_empty_block(self):
+        self.assert_tables('Empty MV', pandas.DataFrame(
+            numpy.zeros((0, 3)),
+            index=pandas.RangeIndex(20, 20),
+            columns=YEARS
+        ), 'Empty table', type=float, columns=YEARS)
+
+    def test_unclosed_block(self):
+        for lazy, pjnz in self.pjnz_files():
+            with self.subTest(lazy=lazy):
+                with self.assertRaises(ValueError):
+                    pjnz.extract_dp_table('Open MV', float, YEARS)
+                with self.assertRaises(ValueError):
+                    pjnz.extract_dp_table('Missing MV', float, YEARS)
+
+    def test_input_hashes_match(self):
+        eager, lazy = [pjnz for lazy, pjnz in self.pjnz_files()]
+        for key in ['dp:Flat MV', 'dp:Outer MV', 'dp:Empty MV', 'dp:Missing MV']:
+            self.assertEqual(eager.input_hash(key), lazy.input_hash(key))
+        self.assertIsNone(eager.input_hash('dp:Missing MV'))
+
+    def test_in_memory_files(self):
+        data = make_pjnz()
+        for fpath in (bytes(data), memoryview(data), io.BytesIO(data)):
+            with self.subTest(type=type(fpath).__name__):
+                pjnz = PJNZFile(fpath, epp_backend='native')
+                self.assertEqual(pjnz.fname, 'Test_2019')
+                self.assertEqual(pjnz.country, 'Test')
+        with self.assertRaises(TypeError):
+            PJNZFile(42)
+
+
+if __name__ == '__main__':
+    unittest.main()
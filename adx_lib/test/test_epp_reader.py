@@ -0,0 +1,63 @@
+"""
+A regression test of the native EPP reader, against tables derived by hand
+from the EPP project in test/fixtures. They follow SpecIO's reading of the
+xml, but weren't saved from SpecIO itself - check real files against SpecIO
+with epp_parity, which can also save its tables here with --save-expected.
+Run from the repository root with
+
+    python -m pytest adx_lib/test
+"""
+from adx_lib.pjnz_file import PJNZFile
+from adx_lib.test.epp_parity import epp_tables, read_expected
+import io
+import os
+import pandas
+import unittest
+import zipfile
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# A DP sheet without any tables, as only the EPP data is read
+DP_SHEET = '"<General>",Description,,1970\r\n'
+
+
+def make_pjnz(name):
+    """
+    Returns the bytes of a PJNZ file holding the named fixture EPP project.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as pjnz_file:
+        pjnz_file.writestr(name + '.DP', DP_SHEET)
+        pjnz_file.write(os.path.join(FIXTURES, name + '.xml'), name + '.xml')
+    return bytearray(buffer.getvalue())
+
+
+class NativeEPPReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pjnz = PJNZFile(make_pjnz('Fixture_2019'), epp_backend='native')
+        self.expected, self.epidemic_type = read_expected(
+            os.path.join(FIXTURES, 'Fixture_2019_epp')
+        )
+
+    def test_epidemic_type(self):
+        self.assertEqual(self.pjnz.epidemic_type, self.epidemic_type)
+
+    def test_tables(self):
+        for table in epp_tables:
+            with self.subTest(table=table):
+                actual = self.pjnz.epp(table)
+                if self.expected[table] is None:
+                    self.assertIsNone(actual)
+                    continue
+                self.assertIsNotNone(actual)
+                pandas.testing.assert_frame_equal(
+                    actual,
+                    self.expected[table],
+                    check_dtype=False,
+                    check_index_type=False
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Tests resolving the declarative spectrum_file_mappings of schema fields into
+table data. Run from the repository root with
+
+    python -m pytest adx_lib/test
+"""
+from adx_lib.spectrum_tables import build_spectrum_table, resolve_mappings
+import numpy
+import pandas
+import unittest
+
+YEARS = ['1970', '1971', '1972']
+
+
+class SpectrumFile(object):
+    """
+    Stands in for a PJNZFile, serving fixed dp() and epp() tables and
+    counting how often each is read.
+    """
+
+    def __init__(self, dp_tables, epp_tables=None):
+        self.dp_tables = dp_tables
+        self.epp_data = dict(epp_tables or {})
+        self.reads = {}
+
+    def dp(self, tag):
+        self.reads[tag] = self.reads.get(tag, 0) + 1
+        if tag not in self.dp_tables:
+            raise ValueError("<" + tag + "> not found in DP sheet")
+        return self.dp_tables[tag]
+
+    def epp(self, table):
+        raise ValueError("EPP table " + table + " isn't available")
+
+
+def make_spectrum_file():
+    return SpectrumFile({
+        'ART MV': pandas.DataFrame(
+            [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]],
+            index=[0, 1],
+            columns=YEARS
+        ),
+        'Ints MV': pandas.DataFrame({
+            '1970': pandas.array([1, None], dtype='Int64'),
+            '1971': pandas.array([3, 4], dtype='Int64'),
+            '1972': numpy.array([5, 6])
+        })
+    }, {
+        'combined_anc': pandas.DataFrame({
+            'Type': ['A', 'B', 'A'],
+            'Site': ['One', 'Two', 'Three'],
+            '2000': [0.1, 0.2, 0.3],
+            '2001': [0.4, 0.5, 0.6]
+        })
+    })
+
+
+def field(name, **mapping):
+    return {'name': name, 'spectrum_file_mapping': mapping}
+
+
+class ResolveMappingsTest(unittest.TestCase):
+
+    def test_rows(self):
+        spectrum_file = make_spectrum_file()
+        block = resolve_mappings(spectrum_file, [
+            field('Second', dp='ART MV', row=1),
+            field('First', dp='ART MV', row=0, scale=10)
+        ])
+        numpy.testing.assert_array_equal(block, [[4, 5, 6], [10, 20, 30]])
+        self.assertEqual(block.dtype, float)
+        # Fields reading a table in the same way share one read of it
+        self.assertEqual(spectrum_file.reads, {'ART MV': 1})
+
+    def test_columns_by_label(self):
+        block = resolve_mappings(make_spectrum_file(), [
+            field('1971', dp='ART MV', column='1971'),
+            field('1970', dp='ART MV', column=0)
+        ])
+        numpy.testing.assert_array_equal(block, [[2, 5], [1, 4]])
+
+    def test_filter(self):
+        block = resolve_mappings(make_spectrum_file(), [
+            field('Site', epp='combined_anc', column='Site', filter={'Type': 'A'}),
+            field('2001', epp='combined_anc', column='2001', filter={'Type': 'A'})
+        ])
+        self.assertEqual(block.dtype, object)
+        self.assertEqual(list(block[0]), ['One', 'Three'])
+        self.assertEqual(list(block[1]), [0.4, 0.6])
+
+    def test_columns(self):
+        block = resolve_mappings(make_spectrum_file(), [
+            field('Kept', dp='ART MV', row=0, columns=['1971', '1972']),
+            field('All', dp='ART MV', row=1)
+        ])
+        numpy.testing.assert_array_equal(block, [[2, 3, numpy.nan], [4, 5, 6]])
+
+    def test_nullable_table(self):
+        block = resolve_mappings(make_spectrum_file(), [
+            field('Ints', dp='Ints MV', row=0),
+            field('More ints', dp='Ints MV', row=1)
+        ])
+        self.assertEqual(block.dtype, float)
+        numpy.testing.assert_array_equal(block, [[1, 3, 5], [numpy.nan, 4, 6]])
+
+    def test_failed_group(self):
+        # Only the fields of the group that fails are left empty
+        with self.assertLogs(level='ERROR') as logs:
+            block = resolve_mappings(make_spectrum_file(), [
+                field('Good', dp='ART MV', row=0),
+                field('Bad', dp='Missing MV', row=0),
+                field('Also bad', dp='ART MV', column='1999')
+            ])
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('for Bad =>', logs.output[0])
+        numpy.testing.assert_array_equal(block[0], [1, 2, 3])
+        self.assertTrue(numpy.isnan(block[1:]).all())
+
+    def test_every_group_failed(self):
+        with self.assertLogs(level='ERROR'):
+            block = resolve_mappings(make_spectrum_file(), [field('Bad', dp='Missing MV', row=0)])
+        self.assertEqual(block.shape, (1, 0))
+
+
+class BuildSpectrumTableTest(unittest.TestCase):
+
+    schema = {'fields': [
+        {'name': 'Indicator'},
+        field('Good', dp='ART MV', row=0),
+        field('Kept', dp='ART MV', row=1, columns=['1970']),
+        field('Bad', dp='Missing MV', row=0)
+    ]}
+
+    def build(self, columns):
+        with self.assertLogs(level='ERROR'):
+            return build_spectrum_table(
+                make_spectrum_file(), self.schema, orient='index', columns=columns
+            )
+
+    def test_padded_columns(self):
+        table = self.build(YEARS + ['1973'])
+        self.assertEqual(list(table.columns), ['Indicator'] + YEARS + ['1973'])
+        numpy.testing.assert_array_equal(table.loc['Good', YEARS + ['1973']], [1, 2, 3, numpy.nan])
+        numpy.testing.assert_array_equal(table.loc['Kept', YEARS], [4, numpy.nan, numpy.nan])
+        self.assertTrue(table.loc['Bad', YEARS].isnull().all())
+
+    def test_trimmed_columns(self):
+        table = self.build(YEARS[:2])
+        numpy.testing.assert_array_equal(table.loc['Good', YEARS[:2]], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Tests storing tables in, and evicting them from, the on-disk PJNZCache. Run
+from the repository root with
+
+    python -m pytest adx_lib/test
+"""
+from adx_lib.pjnz_cache import PJNZCache
+import numpy
+import os
+import pandas
+import shutil
+import tempfile
+import unittest
+
+FILE_HASH = 'f' * 40
+
+
+class PJNZCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = PJNZCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def round_trip(self, table, **extra):
+        key = PJNZCache.key('round trip')
+        self.cache.put(FILE_HASH, key, table, **extra)
+        return self.cache.get(FILE_HASH, key)
+
+    def test_int_table(self):
+        table = pandas.DataFrame({
+            '1970': pandas.array([1, None, 3], dtype='Int64'),
+            '1971': pandas.array([4, 5, 6], dtype='Int64')
+        }, index=pandas.Index([10, 11, 12], name='row'))
+        found, cached, extra = self.round_trip(table)
+        self.assertTrue(found)
+        pandas.testing.assert_frame_equal(cached, table)
+
+    def test_object_table(self):
+        table = pandas.DataFrame(
+            [[u'Site A', 0.1], [None, 0.2], [u'Site é', numpy.nan]],
+            index=['1', '2', '3'],
+            columns=['Site', 2000]
+        )
+        found, cached, extra = self.round_trip(table)
+        self.assertTrue(found)
+        self.assertEqual(list(cached.columns), ['Site', 2000])
+        self.assertEqual(list(cached.index), ['1', '2', '3'])
+        self.assertEqual(list(cached['Site'].iloc[[0, 2]]), [u'Site A', u'Site é'])
+        self.assertTrue(pandas.isnull(cached['Site'].iloc[1]))
+        numpy.testing.assert_array_equal(cached[2000], table[2000])
+
+    def test_none_table(self):
+        self.assertEqual(self.round_trip(None, epidemic_type='generalized'),
+                         (True, None, {'epidemic_type': 'generalized'}))
+
+    def test_name_and_tag(self):
+        table = pandas.DataFrame({'1970': [1.0], '1971': [2.0]})
+        table.name = 'ART by year'
+        table.tag = '<ART MV>'
+        found, cached, extra = self.round_trip(table)
+        self.assertEqual(cached.name, 'ART by year')
+        self.assertEqual(cached.tag, '<ART MV>')
+        pandas.testing.assert_frame_equal(cached, table)
+
+    def test_missing_table(self):
+        self.assertEqual(self.cache.get(FILE_HASH, PJNZCache.key('missing')), (False, None, {}))
+
+    def test_corrupt_archive(self):
+        key = PJNZCache.key('corrupt')
+        self.cache.put(FILE_HASH, key, pandas.DataFrame({'a': [1.0]}))
+        path = self.cache._path(FILE_HASH, key)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) // 2)
+        self.assertEqual(self.cache.get(FILE_HASH, key), (False, None, {}))
+        self.assertFalse(os.path.exists(path))
+
+    def test_least_recently_used_evicted(self):
+        table = pandas.DataFrame({'a': numpy.arange(1000.0)})
+        keys = [PJNZCache.key('lru', n) for n in range(3)]
+        for n, key in enumerate(keys):
+            self.cache.put(FILE_HASH, key, table)
+            # Ages the tables, oldest first
+            os.utime(self.cache._path(FILE_HASH, key), (1000 + n, 1000 + n))
+        size = os.path.getsize(self.cache._path(FILE_HASH, keys[0]))
+
+        # Reading the oldest table marks it as recently used
+        self.assertTrue(self.cache.get(FILE_HASH, keys[0])[0])
+        self.cache.max_bytes = size * 3
+        self.cache.put(FILE_HASH, PJNZCache.key('lru', 3), table)
+
+        self.assertTrue(os.path.exists(self.cache._path(FILE_HASH, keys[0])))
+        self.assertFalse(os.path.exists(self.cache._path(FILE_HASH, keys[1])))
+        self.assertTrue(os.path.exists(self.cache._path(FILE_HASH, keys[2])))
+        self.assertEqual(self.cache._total_bytes, size * 3)
+
+    def test_replace_file(self):
+        path = os.path.join(self.directory, 'table' + PJNZCache.suffix)
+        for contents in (b'first', b'second'):
+            temp_path = os.path.join(self.directory, 'table.tmp')
+            with open(temp_path, 'wb') as f:
+                f.write(contents)
+            PJNZCache.replace_file(temp_path, path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), contents)
+            self.assertFalse(os.path.exists(temp_path))
+
+    def test_unreplaceable_file_kept(self):
+        # A directory can't be replaced by a file on any platform
+        path = os.path.join(self.directory, 'spilled')
+        os.mkdir(path)
+        temp_path = os.path.join(self.directory, 'spilled.tmp')
+        open(temp_path, 'wb').close()
+        PJNZCache.replace_file(temp_path, path)
+        self.assertTrue(os.path.isdir(path))
+        self.assertFalse(os.path.exists(temp_path))
+
+
+if __name__ == '__main__':
+    unittest.main()